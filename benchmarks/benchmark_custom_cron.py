@@ -0,0 +1,226 @@
+#! /usr/bin/python3
+# -*- encoding: utf8 -*-
+
+"""Measure the cost of custom_cron.py on top of the executed script
+
+Run from the root of the repository :
+
+    python3 benchmarks/benchmark_custom_cron.py --output report.json
+    python3 benchmarks/benchmark_custom_cron.py --compare report.json --tolerance 0.25
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_PATH)
+
+from src.custom_cron import ArgumentsParser, CustomCron, EmailBodySink
+from tests.local_smtp_server import LocalSMTPServer
+
+CUSTOM_CRON_PATH = os.path.join(REPOSITORY_PATH, 'src', 'custom_cron.py')
+HELLO_PATH = os.path.join(REPOSITORY_PATH, 'tests', 'hello.sh')
+SMTP_PORT = 1125
+KB = 1024
+SIZE_SUFFIXES = {'K': KB, 'M': KB**2, 'G': KB**3}
+
+
+class Benchmark(object):
+
+    def __init__(self, args):
+        self.repeat = args.repeat
+        self.output_sizes = [size for size in (KB, 32*KB, KB**2, 32*KB**2, KB**3, 4*KB**3) if size <= args.max_output_size]
+        self.work_path = tempfile.mkdtemp(prefix='custom_cron_benchmark')
+
+    def run(self):
+        try:
+            return {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'timestamp': time.time(),
+                'repeat': self.repeat,
+                'results': {
+                    'startup': self.startup(),
+                    'overhead': self.overhead(),
+                    'throughput': self.throughput(),
+                    'email': self.email(),
+                },
+            }
+        finally:
+            shutil.rmtree(self.work_path)
+
+    def startup(self):
+        configuration_path = os.path.join(self.work_path, 'configuration.ini')
+        with open(configuration_path, 'w') as configuration:
+            configuration.write("[script]\npath = {0}\n\n[log]\npath = {1}\n".format(
+                HELLO_PATH, os.path.join(self.work_path, 'log')))
+        interpreter = self._median_time([sys.executable, '-c', 'pass'])
+        import_and_load = self._median_time([sys.executable, '-c', (
+            "import sys; sys.path.insert(0, {0!r}); "
+            "from src.custom_cron import ArgumentsParser, CustomCron; "
+            "CustomCron(ArgumentsParser().parse(['--configuration', {1!r}]))").format(REPOSITORY_PATH, configuration_path)])
+        return {
+            'import_seconds': self._import_time(),
+            'interpreter_seconds': interpreter,
+            'import_and_configuration_seconds': import_and_load,
+            'custom_cron_startup_seconds': import_and_load - interpreter,
+        }
+
+    def overhead(self):
+        bare = self._median_time([HELLO_PATH])
+        wrapped = self._median_time([sys.executable, CUSTOM_CRON_PATH, HELLO_PATH])
+        return {
+            'bare_exec_seconds': bare,
+            'wrapped_exec_seconds': wrapped,
+            'overhead_seconds': wrapped - bare,
+        }
+
+    def throughput(self):
+        generator_path = os.path.join(self.work_path, 'generator.sh')
+        with open(generator_path, 'w') as generator:
+            generator.write('#! /bin/sh\n\nyes "The quick brown fox jumps over the lazy dog 0123456789" | head -c $1\n')
+        os.chmod(generator_path, 0o755)
+        log_path = os.path.join(self.work_path, 'log')
+        results = []
+        for size in self.output_sizes:
+            durations = []
+            peak_rss_kb = 0
+            for _ in range(self.repeat if size < KB**3 else 1):
+                if os.path.exists(log_path):
+                    os.remove(log_path)
+                duration, rusage = self._execute([sys.executable, CUSTOM_CRON_PATH, '--logfile', log_path,
+                                                  generator_path, '--script_args', str(size)])
+                durations.append(duration)
+                peak_rss_kb = max(peak_rss_kb, rusage.ru_maxrss)
+            duration = statistics.median(durations)
+            results.append({
+                'output_bytes': size,
+                'seconds': duration,
+                'megabytes_per_second': size / KB**2 / duration,
+                'peak_rss_kb': peak_rss_kb,
+            })
+        return results
+
+    def email(self):
+        smtp_server = LocalSMTPServer(SMTP_PORT)
+        smtp_server.start()
+        while smtp_server.ready is not True:
+            time.sleep(0.01)
+        args = ArgumentsParser().parse(['--smtp_host', '127.0.0.1', '--smtp_port', str(SMTP_PORT),
+                                        '--email_to', 'benchmark@localhost', HELLO_PATH])
+        custom_cron = CustomCron(args)
+        line = "The quick brown fox jumps over the lazy dog 0123456789\n"
+        results = []
+        try:
+            for size in (KB, KB**2, 10*KB**2):
+                build_durations = []
+                send_durations = []
+                for _ in range(self.repeat):
+                    start = time.perf_counter()
+                    email_body = EmailBodySink(custom_cron.email_max_body_size)
+                    for _ in range(size // len(line)):
+                        email_body.write(line)
+                    run = {'start': time.time(), 'duration': 0, 'usage': None}
+                    build_durations.append(time.perf_counter() - start)
+                    custom_cron._send_email(0, email_body, run)
+                    send_durations.append(run['email_send_time'])
+                results.append({
+                    'output_bytes': size,
+                    'build_seconds': statistics.median(build_durations),
+                    'send_seconds': statistics.median(send_durations),
+                })
+        finally:
+            smtp_server.stop()
+        return results
+
+    def _import_time(self):
+        """Median cumulative import time of custom_cron reported by python -X importtime"""
+        durations = []
+        for _ in range(self.repeat):
+            result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import custom_cron'],
+                                    cwd=os.path.dirname(CUSTOM_CRON_PATH), stderr=subprocess.PIPE, universal_newlines=True)
+            line = [line for line in result.stderr.splitlines() if line.endswith('| custom_cron')][0]
+            durations.append(int(line.split('|')[1]) / 1e6)
+        return statistics.median(durations)
+
+    def _median_time(self, command):
+        return statistics.median(self._execute(command)[0] for _ in range(self.repeat))
+
+    def _execute(self, command):
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=self.work_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return time.perf_counter() - start, rusage
+
+
+class ReportComparison(object):
+    """Find the durations and memory usages which grew more than the tolerance since the baseline report"""
+
+    COMPARED_KEYS = ('seconds', 'peak_rss_kb')
+
+    def __init__(self, baseline, report, tolerance):
+        self.baseline = baseline
+        self.report = report
+        self.tolerance = tolerance
+
+    def regressions(self):
+        baseline = dict(self._measures(self.baseline['results']))
+        regressions = []
+        for name, value in self._measures(self.report['results']):
+            if name in baseline and baseline[name] > 0 and value > baseline[name] * (1 + self.tolerance):
+                regressions.append("{0} : {1:.6g} -> {2:.6g} (+{3:.0%})".format(
+                    name, baseline[name], value, value / baseline[name] - 1))
+        return regressions
+
+    def _measures(self, results, prefix=''):
+        if isinstance(results, list):
+            for result in results:
+                for measure in self._measures(result, "{0}[{1}]".format(prefix, result['output_bytes'])):
+                    yield measure
+            return
+        for key, value in sorted(results.items()):
+            if isinstance(value, (dict, list)):
+                for measure in self._measures(value, prefix + '.' + key if prefix else key):
+                    yield measure
+            # Overheads are differences of two measures, too noisy to be compared
+            elif key.endswith(self.COMPARED_KEYS) and not key.startswith(('overhead', 'custom_cron_startup')):
+                yield "{0}.{1}".format(prefix, key), value
+
+
+def parse_size(size):
+    if size[-1:].upper() in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1:].upper()])
+    return int(size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the overhead, output throughput and email latency of custom_cron.py')
+    parser.add_argument('--repeat', type=int, default=5, help='number of measures of each benchmark (default: 5)')
+    parser.add_argument('--max_output_size', type=parse_size, default=parse_size('32M'),
+                        help='largest output measured, up to 4G (default: 32M)')
+    parser.add_argument('--output', default=None, help='path of the JSON report (default: stdout)')
+    parser.add_argument('--compare', default=None, help='path of a baseline JSON report, exit with status 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='accepted growth of a measure compared to the baseline (default: 0.25)')
+    args = parser.parse_args()
+    report = Benchmark(args).run()
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare is not None:
+        with open(args.compare, 'r') as baseline:
+            regressions = ReportComparison(json.load(baseline), report, args.tolerance).regressions()
+        for regression in regressions:
+            sys.stderr.write("REGRESSION : {0}\n".format(regression))
+        sys.exit(1 if regressions else 0)
@@ -1,21 +1,69 @@
 #! /usr/bin/python3
 # -*- encoding: utf8 -*-
 
+# Only the modules needed by every execution are imported here, the email, configuration, history, metrics
+# and scheduler modules are imported by the functions using them to keep the startup of short runs fast
 import subprocess, os, sys
-from smtplib import SMTP, SMTPNotSupportedError
-from tempfile import TemporaryFile
-from email.mime.text import MIMEText
+import codecs
+import collections
+import fcntl
+import re
+import select
+import signal
+import threading
+import time
 import argparse
-import configparser
+
+
+OUTPUT_CHUNK_SIZE = 64 * 1024
+OUTPUT_FLUSH_INTERVAL = 1
+EXIT_POLL_INTERVAL = 0.05
+# 1 MiB, the largest default size of a pipe buffer
+OUTPUT_DRAIN_MAX_CHUNKS = 16
+LOG_BUFFER_SIZE = 64 * 1024
+EMAIL_BODY_MAX_SIZE = 10 * 1024 * 1024
+DIGEST_OUTPUT_MAX_SIZE = 4 * 1024
+HISTORY_OUTPUT_MAX_SIZE = 64 * 1024
+SLOTS_DIRECTORY = '/run/custom_cron/slots'
+SHIPPING_OUTPUT_MAX_SIZE = 32 * 1024
+SHIPPING_SPOOL_MAX_SIZE = 10 * 1024 * 1024
+ENTRY_POINT_PREFIX = 'python:'
 
 
 class CustomCron(object):
 
-    def __init__(self, args):
+    def __init__(self, args, resources=None, configuration=None):
+        self.resources = resources
+        self.configuration = configuration
         self.configuration_path = None
         self.log_path = None
+        self.log_format = 'raw'
+        self.log_max_size = None
+        self.log_rotate_every = None
+        self.log_backups = 5
+        self.log_compress = True
+        self.log_ship = None
+        self.log_ship_spool = None
+        self.log_ship_spool_max_size = SHIPPING_SPOOL_MAX_SIZE
+        self.history_path = None
+        self.history_retention_days = 90
+        self.metrics_textfile = None
+        self.metrics_statsd = None
+        self.metrics_prefix = 'custom_cron'
         self.email_address = None
         self.email_only_on_fail = False
+        self.email_outbox = None
+        self.email_digest = None
+        self.email_digest_interval = 60*60
+        self.email_digest_failures_immediately = False
+        self.email_max_body_size = EMAIL_BODY_MAX_SIZE
+        self.email_body_lines = None
+        self.email_attach_above = None
+        self.email_full_output = 'attach'
+        self.email_resource_usage = False
+        self.email_dedup = None
+        self.email_reminder_interval = 24*60*60
+        self.email_dedup_ttl = 7*24*60*60
         self.smtp_connection = {
             'host': None,
             'port': None,
@@ -24,23 +72,311 @@ class CustomCron(object):
         }
         self.script_to_execute = None
         self.script_to_execute_timeout = None
+        self.script_to_execute_kill_grace = 5
+        self.nice = None
+        self.ionice = None
+        self.cpu_affinity = None
+        self.limit_cpu = None
+        self.limit_memory = None
+        self.limit_files = None
+        self.limit_file_size = None
         self.script_to_execute_args = []
+        self.python_preload = []
+        self.fork_server = None
+        self.stats_path = None
+        self.job_name = None
+        self.jobs = []
+        self.max_parallel = os.cpu_count() or 1
+        self.max_load = None
+        self.splay = None
+        self.slot = None
+        self.slots = {}
+        self.slots_directory = SLOTS_DIRECTORY
+        self.lease = None
+        self.lease_duration = 60
+        self.lease_window = 60
         self._initialize_configuration(args)
 
-    def execute_script(self):
-        script_exit_code, script_output = self._execute_script()
-        print(script_output)
-        if self._is_log_needed():
-            self._write_log(script_output)
-        if self._is_email_needed():
-            self._send_email(script_exit_code, script_output)
+    def for_script(self, script_to_execute, script_to_execute_args):
+        import copy
+        custom_cron = copy.copy(self)
+        custom_cron.smtp_connection = dict(self.smtp_connection)
+        custom_cron.script_to_execute = script_to_execute
+        custom_cron.script_to_execute_args = list(script_to_execute_args)
+        custom_cron.jobs = []
+        return custom_cron
+
+    def execute_script(self, scheduled_time=None):
+        if len(self.jobs) > 0:
+            return self.execute_jobs()
+        if scheduled_time is None:
+            scheduled_time = time.time()
+        if self.splay is not None:
+            time.sleep(self._splay_delay())
+        if self.resources is not None or self.fork_server is not None or not self._is_fork_server_needed():
+            return self._execute_instance(scheduled_time)
+        # Forked before the execution starts any thread, like the renewal of the lease
+        self.fork_server = ForkServer(self.python_preload)
+        self.fork_server.start()
+        try:
+            return self._execute_instance(scheduled_time)
+        finally:
+            self.fork_server.close()
+            self.fork_server = None
+
+    def _execute_instance(self, scheduled_time):
+        lease, lease_error = None, None
+        try:
+            lease = self._acquire_lease(scheduled_time)
+        except OSError as e:
+            # Reported like a failure of the script, rather than no host executing it silently
+            lease_error = e
+        if lease is not None and lease.token is None:
+            print("Skipped : {0} is executed by an other host".format(self.script_to_execute))
+            return 0
+        slot = None
+        output = ScriptOutput()
+        executed = False
+        try:
+            try:
+                # The slot and the lease are released below even when a sink cannot be set up
+                slot = self._acquire_slot()
+                start_time = time.time()
+                run = {
+                    'id': os.urandom(8).hex(),
+                    'host': os.uname()[1],
+                    'script': self.script_to_execute,
+                    'start': start_time,
+                    'lease_token': lease.token if lease is not None else None,
+                    'lease_error': str(lease_error) if lease_error is not None else None,
+                }
+                output.add(ConsoleSink(self.job_name))
+                log = None
+                if self._is_log_needed():
+                    log = output.add(LogSink(self._log_file(), self.log_format, run))
+                email_body = None
+                if self._is_email_needed():
+                    email_body = output.add(EmailBodySink(self.email_max_body_size, self.email_body_lines,
+                                                          spool=self.email_attach_above is not None))
+                history_output = None
+                if self._is_history_needed():
+                    # Same head and tail excerpt as the email body
+                    history_output = output.add(EmailBodySink(HISTORY_OUTPUT_MAX_SIZE))
+                shipping_output = None
+                if self._is_shipping_needed():
+                    shipping_output = output.add(EmailBodySink(SHIPPING_OUTPUT_MAX_SIZE))
+                executed = True
+                script_exit_code = self._execute_script(output, run)
+            finally:
+                if lease is not None and not executed:
+                    # Not executed, an other host takes the instance over once the lease expires
+                    lease.abandon()
+                lease_lost = lease is not None and not lease.release()
+            if lease_lost:
+                output.write("ERROR : Lease lost, an other host may have executed the script too\n")
+            run['exit_code'] = script_exit_code
+            run['duration'] = time.time() - start_time
+            run['output_size'] = output.size
+            if log is not None:
+                log.finish()
+        finally:
+            output.close()
+            if slot is not None:
+                slot.release()
+        if self.stats_path is not None:
+            self._write_stats(run)
+        if history_output is not None:
+            self._record_history(run, history_output.getvalue())
+        if shipping_output is not None:
+            self._ship_log(run, shipping_output.getvalue())
+        run['email_send_time'] = None
+        run['email_error'] = None
+        try:
+            if email_body is not None:
+                try:
+                    self._send_email(script_exit_code, email_body, run)
+                except OSError as e:
+                    run['email_error'] = str(e)
+                    raise
+                finally:
+                    email_body.discard()
+        finally:
+            # A run whose email failed is the one the monitoring must see
+            if self._is_metrics_needed():
+                MetricsExporter(self.metrics_textfile, self.metrics_statsd, self.metrics_prefix).emit(run)
+        return script_exit_code
+
+    def execute_jobs(self):
+        """Execute every job of the configuration with at most max_parallel jobs at once"""
+        import concurrent.futures
+        futures = {}
+        # Every job belongs to the same scheduled instance, even when it waits for a worker
+        scheduled_time = time.time()
+        start = time.monotonic()
+        instances = [self._job_instance(job) for job in self.jobs]
+        # The splay delays the submission of a job rather than holding a worker of the pool while it sleeps
+        delays = [instance._splay_delay() if instance.splay is not None else 0 for instance in instances]
+        fork_server = None
+        if self.resources is None and any(instance._is_fork_server_needed() for instance in instances):
+            # Shared by the jobs and forked before the threads of the pool
+            fork_server = ForkServer(self.python_preload)
+            fork_server.start()
+            for instance in instances:
+                instance.fork_server = fork_server
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_parallel) as pool:
+                for index in sorted(range(len(instances)), key=lambda index: delays[index]):
+                    time.sleep(max(start + delays[index] - time.monotonic(), 0))
+                    instances[index].splay = None
+                    self._wait_for_worker(list(futures.values()))
+                    futures[index] = pool.submit(self._execute_job, instances[index], scheduled_time)
+        finally:
+            if fork_server is not None:
+                fork_server.close()
+        results = [(job['name'], futures[index].result()) for index, job in enumerate(self.jobs)]
+        print(self._jobs_summary(results))
+        return 0 if all(exit_code == 0 for _, (exit_code, _) in results) else 1
+
+    def _write_stats(self, run):
+        import json
+        stats = dict((key, run[key]) for key in ('id', 'host', 'script', 'start', 'duration', 'exit_code', 'limit_exceeded',
+                                                  'usage'))
+        with open(self.stats_path, 'a', encoding='utf-8') as stats_file:
+            fcntl.flock(stats_file, fcntl.LOCK_EX)
+            stats_file.write(json.dumps(stats) + '\n')
+
+    def _record_history(self, run, script_output):
+        if self.resources is not None:
+            history = self.resources.history_store(self.history_path)
+        else:
+            history = HistoryStore(self.history_path)
+        try:
+            history.record(run, script_output, self.log_path)
+            history.prune(self.history_retention_days)
+        finally:
+            if self.resources is None:
+                history.close()
+
+    def _ship_log(self, run, script_output):
+        record = dict((key, run[key]) for key in ('id', 'host', 'script', 'start', 'duration', 'exit_code', 'timed_out',
+                                                   'limit_exceeded', 'output_size', 'usage'))
+        record['output'] = script_output
+        if self.resources is not None:
+            self.resources.log_shipper(self.log_ship, self.log_ship_spool, self.log_ship_spool_max_size).ship(record)
+            return
+        log_shipper = LogShipper(self.log_ship, self.log_ship_spool, self.log_ship_spool_max_size)
+        log_shipper.ship(record)
+        log_shipper.close()
+
+    def _log_file(self):
+        if self.resources is not None:
+            return self.resources.log_file(self.log_path, self._log_file_settings())
+        return LogFile(self.log_path, keep_open=False, **self._log_file_settings())
+
+    def _log_file_settings(self):
+        return {
+            'max_size': self.log_max_size,
+            'rotate_every': self.log_rotate_every,
+            'backups': self.log_backups,
+            'compress': self.log_compress,
+        }
+
+    def _execute_job(self, custom_cron, scheduled_time):
+        start = time.monotonic()
+        try:
+            script_exit_code = custom_cron.execute_script(scheduled_time)
+        except Exception as e:
+            sys.stderr.write("ERROR : Job {0} failed : {1}\n".format(custom_cron.job_name, e))
+            script_exit_code = 1
+        return script_exit_code, time.monotonic() - start
+
+    def _job_instance(self, job):
+        custom_cron = self.for_script(job['path'], job['arguments'] if job['arguments'] is not None else [])
+        custom_cron.job_name = job['name']
+        if job['timeout'] is not None:
+            custom_cron.script_to_execute_timeout = job['timeout']
+        if job['log_path'] is not None:
+            custom_cron.log_path = job['log_path']
+        if job['email_address'] is not None:
+            custom_cron.email_address = job['email_address']
+        if job['email_only_on_fail'] is not None:
+            custom_cron.email_only_on_fail = job['email_only_on_fail']
+        if job['slot'] is not None:
+            custom_cron.slot = job['slot']
+        return custom_cron
+
+    def _wait_for_worker(self, futures):
+        import concurrent.futures
+        while True:
+            running = [future for future in futures if not future.done()]
+            if len(running) >= self.max_parallel:
+                concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            elif len(running) > 0 and self.max_load is not None and os.getloadavg()[0] > self.max_load:
+                # Hold back new jobs while the host is overloaded, unless no other job is running
+                concurrent.futures.wait(running, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+            else:
+                return
+
+    def _splay_delay(self):
+        """Same delay in [0, splay) on every execution of a script on a host, different between scripts and hosts"""
+        import hashlib
+        key = '\0'.join([os.uname()[1], self.script_to_execute or ''] + self.script_to_execute_args)
+        return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % self.splay
+
+    def _acquire_slot(self):
+        if self.slot is None:
+            return None
+        slot = HostSemaphore(self.slots_directory, self.slot, self.slots.get(self.slot, 1))
+        slot.acquire()
+        return slot
+
+    def _acquire_lease(self, scheduled_time):
+        """Return None without lease backend, else the lease of the scheduled instance, without token if not acquired"""
+        if self.lease is None:
+            return None
+        lease = Lease(LeaseBackend.from_url(self.lease), self._lease_name(scheduled_time),
+                      "{0}:{1}".format(os.uname()[1], os.getpid()), self.lease_duration)
+        lease.acquire()
+        return lease
+
+    def _lease_name(self, scheduled_time):
+        """Same name on every host for an instance, the scheduled time is rounded so a small clock skew is ignored"""
+        import hashlib
+        key = '\0'.join([self.script_to_execute or ''] + self.script_to_execute_args)
+        job = "{0}-{1}".format(re.sub(r'[^A-Za-z0-9_.-]+', '_', os.path.basename(self.script_to_execute or '')),
+                               hashlib.sha1(key.encode('utf-8')).hexdigest()[:12])
+        return "{0}/{1}".format(job, int(round(scheduled_time / self.lease_window)))
+
+    def _jobs_summary(self, results):
+        failed = len([name for name, (exit_code, _) in results if exit_code != 0])
+        lines = ["Summary : {0} jobs, {1} failed".format(len(results), failed)]
+        for name, (exit_code, duration) in results:
+            status = "OK" if exit_code == 0 else "FAIL"
+            lines.append("  {0} : {1} (exit code {2}, {3:.1f}s)".format(name, status, exit_code, duration))
+        return '\n'.join(lines)
 
     def _initialize_configuration(self, args):
         self.configuration_path = args.configuration_path
         if self.configuration_path is not None:
+            if self.configuration is None:
+                self.configuration = ConfigurationLoader(self.configuration_path, args.configuration_cache)
             self._load_configuration_file()
         if args.log_path is not None:
             self.log_path = args.log_path
+        if args.log_format is not None:
+            self.log_format = args.log_format
+        if args.log_max_size is not None:
+            self.log_max_size = args.log_max_size
+        if args.log_ship is not None:
+            self.log_ship = args.log_ship
+        if args.log_ship_spool is not None:
+            self.log_ship_spool = args.log_ship_spool
+        if args.history_path is not None:
+            self.history_path = args.history_path
+        if args.metrics_textfile is not None:
+            self.metrics_textfile = args.metrics_textfile
+        if args.metrics_statsd is not None:
+            self.metrics_statsd = args.metrics_statsd
         if args.smtp_host is not None:
             self.smtp_connection = {
                 'host': args.smtp_host,
@@ -52,20 +388,101 @@ class CustomCron(object):
             self.email_address = args.email_address
         if self.email_only_on_fail != args.email_only_on_fail:
             self.email_only_on_fail = args.email_only_on_fail
+        if args.email_outbox is not None:
+            self.email_outbox = args.email_outbox
+        if args.email_digest is not None:
+            self.email_digest = args.email_digest
+        if args.email_digest_interval is not None:
+            self.email_digest_interval = args.email_digest_interval
+        if args.email_digest_failures_immediately:
+            self.email_digest_failures_immediately = True
+        if args.email_max_body_size is not None:
+            self.email_max_body_size = args.email_max_body_size
+        if args.email_body_lines is not None:
+            self.email_body_lines = args.email_body_lines
+        if args.email_attach_above is not None:
+            self.email_attach_above = args.email_attach_above
+        if args.email_resource_usage:
+            self.email_resource_usage = True
+        if args.email_dedup is not None:
+            self.email_dedup = args.email_dedup
+        if args.email_reminder_interval is not None:
+            self.email_reminder_interval = args.email_reminder_interval
         if args.script_to_execute is not None:
             self.script_to_execute = args.script_to_execute
+            self.jobs = []
         if args.script_to_execute_timeout is not None:
             self.script_to_execute_timeout = args.script_to_execute_timeout
+        if args.script_to_execute_kill_grace is not None:
+            self.script_to_execute_kill_grace = args.script_to_execute_kill_grace
+        if args.nice is not None:
+            self.nice = args.nice
+        if args.ionice is not None:
+            self.ionice = ResourceControls.parse_ionice(args.ionice)
+        if args.cpu_affinity is not None:
+            self.cpu_affinity = ResourceControls.parse_cpu_affinity(args.cpu_affinity)
+        for limit in ResourceControls.LIMITS:
+            if getattr(args, limit) is not None:
+                setattr(self, limit, getattr(args, limit))
         if len(args.script_to_execute_args) > 0:
             self.script_to_execute_args = args.script_to_execute_args
+        if args.python_preload is not None:
+            self.python_preload = [module.strip() for module in args.python_preload.split(',') if module.strip()]
+        if args.stats_path is not None:
+            self.stats_path = args.stats_path
+        if args.max_parallel is not None:
+            self.max_parallel = args.max_parallel
+        if args.max_load is not None:
+            self.max_load = args.max_load
+        if args.splay is not None:
+            self.splay = args.splay
+        if args.slot is not None:
+            self.slot, _, size = args.slot.partition(':')
+            if size:
+                if not size.isdigit():
+                    raise ValueError("Invalid slot : {0}".format(args.slot))
+                self.slots[self.slot] = int(size)
+        if args.slots_directory is not None:
+            self.slots_directory = args.slots_directory
+        if args.lease is not None:
+            self.lease = args.lease
+        if args.lease_duration is not None:
+            self.lease_duration = args.lease_duration
+        if args.lease_window is not None:
+            self.lease_window = args.lease_window
+        self._check_scheduling()
+
+    def _check_scheduling(self):
+        """Validate the splay and the slot sizes given by the arguments or the configuration"""
+        if self.splay is not None and self.splay < 0:
+            raise ValueError("Invalid splay : {0}".format(self.splay))
+        if self.splay == 0:
+            # No splay, rather than a delay modulo 0
+            self.splay = None
+        for name, size in self.slots.items():
+            if size < 1:
+                raise ValueError("Invalid size of the slot {0} : {1}".format(name, size))
 
     def _load_configuration_file(self):
-        if self.configuration_path is None or not os.path.isfile(self.configuration_path):
-            return
-        config = configparser.ConfigParser()
-        config.read(self.configuration_path)
+        config = self.configuration.load()
         if "log" in config:
             self.log_path = config["log"]["path"] if "path" in config["log"] else None
+            self.log_format = config["log"]["format"] if "format" in config["log"] else 'raw'
+            self.log_max_size = config["log"]["max_size"] if "max_size" in config["log"] else None
+            self.log_rotate_every = config["log"]["rotate_every"] if "rotate_every" in config["log"] else None
+            self.log_backups = config["log"]["backups"] if "backups" in config["log"] else 5
+            self.log_compress = config["log"]["compress"] if "compress" in config["log"] else True
+        if "shipping" in config:
+            self.log_ship = config["shipping"]["target"] if "target" in config["shipping"] else None
+            self.log_ship_spool = config["shipping"]["spool"] if "spool" in config["shipping"] else None
+            self.log_ship_spool_max_size = config["shipping"]["spool_max_size"] if "spool_max_size" in config["shipping"] else SHIPPING_SPOOL_MAX_SIZE
+        if "history" in config:
+            self.history_path = config["history"]["path"] if "path" in config["history"] else None
+            self.history_retention_days = config["history"]["retention_days"] if "retention_days" in config["history"] else 90
+        if "metrics" in config:
+            self.metrics_textfile = config["metrics"]["textfile"] if "textfile" in config["metrics"] else None
+            self.metrics_statsd = config["metrics"]["statsd"] if "statsd" in config["metrics"] else None
+            self.metrics_prefix = config["metrics"]["prefix"] if "prefix" in config["metrics"] else 'custom_cron'
         if "email" in config:
             self.smtp_connection = {
                 'host': config["email"]["smtp_host"] if "smtp_host" in config["email"] else None,
@@ -74,56 +491,456 @@ class CustomCron(object):
                 'password': config["email"]["smtp_password"] if "smtp_password" in config["email"] else None,
             }
             self.email_address = config["email"]["to"] if "to" in config["email"] else None
-            self.email_only_on_fail = config["email"].getboolean("only_on_fail") if "only_on_fail" in config["email"] else False
+            self.email_only_on_fail = config["email"]["only_on_fail"] if "only_on_fail" in config["email"] else False
+            self.email_outbox = config["email"]["outbox"] if "outbox" in config["email"] else None
+            self.email_digest = config["email"]["digest"] if "digest" in config["email"] else None
+            self.email_digest_interval = config["email"]["digest_interval"] if "digest_interval" in config["email"] else self.email_digest_interval
+            self.email_digest_failures_immediately = config["email"]["digest_failures_immediately"] if "digest_failures_immediately" in config["email"] else False
+            self.email_max_body_size = config["email"]["max_body_size"] if "max_body_size" in config["email"] else EMAIL_BODY_MAX_SIZE
+            self.email_body_lines = config["email"]["body_lines"] if "body_lines" in config["email"] else None
+            self.email_attach_above = config["email"]["attach_above"] if "attach_above" in config["email"] else None
+            self.email_full_output = config["email"]["full_output"] if "full_output" in config["email"] else 'attach'
+            self.email_resource_usage = config["email"]["resource_usage"] if "resource_usage" in config["email"] else False
+            self.email_dedup = config["email"]["dedup"] if "dedup" in config["email"] else None
+            self.email_reminder_interval = config["email"]["reminder_interval"] if "reminder_interval" in config["email"] else self.email_reminder_interval
+            self.email_dedup_ttl = config["email"]["dedup_ttl"] if "dedup_ttl" in config["email"] else self.email_dedup_ttl
         if "script" in config:
             self.script_to_execute = config["script"]["path"] if "path" in config["script"] else None
-            self.script_to_execute_timeout = config["script"].getint("timeout") if "timeout" in config["script"] else None
+            self.script_to_execute_timeout = config["script"]["timeout"] if "timeout" in config["script"] else None
+            self.script_to_execute_kill_grace = config["script"]["kill_grace"] if "kill_grace" in config["script"] else 5
+            self.nice = config["script"]["nice"] if "nice" in config["script"] else None
+            self.ionice = ResourceControls.parse_ionice(config["script"]["ionice"]) if "ionice" in config["script"] else None
+            self.cpu_affinity = ResourceControls.parse_cpu_affinity(config["script"]["cpu_affinity"]) if "cpu_affinity" in config["script"] else None
+            for limit in ResourceControls.LIMITS:
+                setattr(self, limit, config["script"][limit] if limit in config["script"] else None)
             self.script_to_execute_args = config["script"]["arguments"].split(' ') if "arguments" in config["script"] else []
+            self.stats_path = config["script"]["stats_file"] if "stats_file" in config["script"] else None
+            self.splay = config["script"]["splay"] if "splay" in config["script"] else None
+            self.slot = config["script"]["slot"] if "slot" in config["script"] else None
+        if "python" in config:
+            self.python_preload = [module.strip() for module in config["python"]["preload"].split(',') if module.strip()] if "preload" in config["python"] else []
+        if "workers" in config:
+            self.max_parallel = config["workers"]["max_parallel"] if "max_parallel" in config["workers"] else self.max_parallel
+            self.max_load = config["workers"]["max_load"] if "max_load" in config["workers"] else None
+        if "slots" in config:
+            self.slots_directory = config["slots"]["directory"] if "directory" in config["slots"] else SLOTS_DIRECTORY
+            self.slots = dict((name, size) for name, size in config["slots"].items() if name != "directory")
+        if "lease" in config:
+            self.lease = config["lease"]["backend"] if "backend" in config["lease"] else None
+            self.lease_duration = config["lease"]["duration"] if "duration" in config["lease"] else 60
+            self.lease_window = config["lease"]["window"] if "window" in config["lease"] else 60
+        self.jobs = [self._load_job_section(section[len("job:"):], config[section])
+                     for section in config if section.startswith("job:")]
 
-    def _execute_script(self):
+    def _load_job_section(self, name, section):
+        return {
+            'name': name,
+            'path': section["path"] if "path" in section else None,
+            'arguments': section["arguments"].split(' ') if "arguments" in section else None,
+            'timeout': section["timeout"] if "timeout" in section else None,
+            'log_path': section["log"] if "log" in section else None,
+            'email_address': section["email_to"] if "email_to" in section else None,
+            'email_only_on_fail': section["only_on_fail"] if "only_on_fail" in section else None,
+            'slot': section["slot"] if "slot" in section else None,
+        }
+
+    def _execute_script(self, output, run):
+        """Return the exit code of the script, its resource usage and whether it timed out are added to the run"""
+        run['usage'] = None
+        run['timed_out'] = False
+        run['limit_exceeded'] = None
+        if run.get('lease_error') is not None:
+            output.write("ERROR : Lease backend unavailable : {0}\n".format(run['lease_error']))
+            return 1
         if self.script_to_execute is None:
-            script_output = "ERROR : No script given\n".format(self.script_to_execute)
-            return 1, script_output
-        if not os.path.isfile(self.script_to_execute):
-            script_output = "ERROR : Script {0} not found\n".format(self.script_to_execute)
-            return 1, script_output
-        script_args = [self.script_to_execute] + self.script_to_execute_args
-        with TemporaryFile(mode='w+t', encoding='utf-8') as tmp_log:
-            try:
-                script_exit_code = subprocess.call(script_args,
-                                                   stdout=tmp_log,
-                                                   stderr=subprocess.STDOUT,
-                                                   timeout=self.script_to_execute_timeout)
-            except subprocess.TimeoutExpired:
-                return 1, "ERROR : Timeout exceeded\n"
-            tmp_log.seek(0)
-            script_output = tmp_log.read()
-        return script_exit_code, script_output
+            output.write("ERROR : No script given\n")
+            return 1
+        is_entry_point = self.script_to_execute.startswith(ENTRY_POINT_PREFIX)
+        if not is_entry_point and not os.path.isfile(self.script_to_execute):
+            output.write("ERROR : Script {0} not found\n".format(self.script_to_execute))
+            return 1
+        deadline = None
+        if self.script_to_execute_timeout is not None:
+            deadline = time.monotonic() + float(self.script_to_execute_timeout)
+        controls = self._resource_controls()
+        limit_errors = None
+        if 'limit_memory' in controls['limits'] or 'limit_files' in controls['limits']:
+            limit_errors = output.add(LimitErrorSink())
+        start = time.monotonic()
+        env = {}
+        if run.get('lease_token') is not None:
+            # Given by the script to the systems it writes to, so they can reject the writes of a previous holder
+            env['CUSTOM_CRON_LEASE_TOKEN'] = str(run['lease_token'])
+        if self._is_fork_server_needed():
+            process = self._fork_server().run(self.script_to_execute, self.script_to_execute_args, controls, env)
+        else:
+            # In its own session, the script and every process it starts can be stopped together on timeout
+            process = subprocess.Popen([self.script_to_execute] + self.script_to_execute_args, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT, start_new_session=True,
+                                       env=dict(os.environ, **env) if env else None)
+        killed_processes = 0
+        with process.stdout:
+            script_exit_code, rusage = self._stream_output(process, output, deadline)
+            if script_exit_code is None:
+                output.write("ERROR : Timeout exceeded\n")
+                run['timed_out'] = True
+                script_exit_code = 1
+                rusage, killed_processes = self._kill(process, output)
+        run['usage'] = self._resource_usage(rusage, time.monotonic() - start, killed_processes)
+        if controls['limits'] and not run['timed_out']:
+            run['limit_exceeded'] = ResourceControls.exceeded_limit(controls['limits'], script_exit_code, run['usage'],
+                                                                    limit_errors)
+            if run['limit_exceeded'] is not None:
+                output.write("ERROR : Limit exceeded : {0}\n".format(run['limit_exceeded']))
+        return script_exit_code
+
+    def _wait4(self, process, options):
+        if isinstance(process, ForkedProcess):
+            return process.wait4(options)
+        return os.wait4(process.pid, options)
+
+    def _is_fork_server_needed(self):
+        """The Python entry points and the scripts with resource controls are started by the fork server"""
+        if self.script_to_execute is not None and self.script_to_execute.startswith(ENTRY_POINT_PREFIX):
+            return True
+        controls = self._resource_controls()
+        return (controls['nice'] is not None or controls['ionice'] is not None or controls['cpu_affinity'] is not None or
+                len(controls['limits']) > 0)
+
+    def _resource_controls(self):
+        """Plain settings of the ResourceControls, which are only built by the worker applying them"""
+        return {
+            'nice': self.nice,
+            'ionice': self.ionice,
+            'cpu_affinity': sorted(self.cpu_affinity) if self.cpu_affinity is not None else None,
+            'limits': dict((limit, getattr(self, limit)) for limit in ResourceControls.LIMITS
+                           if getattr(self, limit) is not None),
+        }
+
+    def _fork_server(self):
+        if self.resources is not None:
+            return self.resources.fork_server(self.python_preload)
+        return self.fork_server
+
+    def _resource_usage(self, rusage, wall_time, killed_processes):
+        return {
+            'wall_time': round(wall_time, 3),
+            'user_time': round(rusage.ru_utime, 3),
+            'system_time': round(rusage.ru_stime, 3),
+            'max_rss_kb': rusage.ru_maxrss,
+            'block_input': rusage.ru_inblock,
+            'block_output': rusage.ru_oublock,
+            'voluntary_switches': rusage.ru_nvcsw,
+            'involuntary_switches': rusage.ru_nivcsw,
+            'killed_processes': killed_processes,
+        }
+
+    def _stream_output(self, process, output, deadline):
+        """Forward the output chunk by chunk as soon as it is produced, until the script exits
+
+        Return the exit code and the resource usage given by wait4, None and None on timeout. The processes left
+        in the background by the script may keep the pipe open, only what is already written is read at the exit.
+        """
+        fd = process.stdout.fileno()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        exit_fd = pidfd = None
+        if isinstance(process, ForkedProcess):
+            exit_fd = process.exit_fd()
+        else:
+            try:
+                exit_fd = pidfd = os.pidfd_open(process.pid)
+            except (AttributeError, OSError):
+                # Before Linux 5.3, the exit of the script is polled
+                pass
+        watched_fds = [fd] if exit_fd is None else [fd, exit_fd]
+        try:
+            while True:
+                wait_time = OUTPUT_FLUSH_INTERVAL if exit_fd is not None else EXIT_POLL_INTERVAL
+                if deadline is not None:
+                    remaining_time = self._remaining_time(deadline)
+                    if remaining_time <= 0:
+                        return None, None
+                    wait_time = min(wait_time, remaining_time)
+                ready, _, _ = select.select(watched_fds, [], [], wait_time)
+                if fd in ready and not self._read_chunk(fd, output, decoder):
+                    # End of the output, the script may still run
+                    watched_fds.remove(fd)
+                if exit_fd is None or exit_fd in ready:
+                    pid, status, rusage = self._wait4(process, os.WNOHANG)
+                    if pid != 0:
+                        if fd in watched_fds:
+                            self._drain(fd, output, decoder)
+                        break
+                if not ready:
+                    # The script is quiet, make the buffered output visible
+                    output.flush()
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+        output.write(decoder.decode(b'', final=True))
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return process.returncode, rusage
+
+    def _read_chunk(self, fd, output, decoder):
+        chunk = os.read(fd, OUTPUT_CHUNK_SIZE)
+        if not chunk:
+            return False
+        output.size += len(chunk)
+        output.write(decoder.decode(chunk))
+        return True
+
+    def _drain(self, fd, output, decoder):
+        # What the script wrote before its exit is in the pipe buffer, a background process writing without a pause
+        # must not keep the wrapper reading
+        for _ in range(OUTPUT_DRAIN_MAX_CHUNKS):
+            if not select.select([fd], [], [], 0)[0] or not self._read_chunk(fd, output, decoder):
+                return
+
+    def _remaining_time(self, deadline):
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
+
+    def _kill(self, process, output):
+        """Stop the process group of the script with SIGTERM, then SIGKILL once the grace period is over
+
+        Return the resource usage of the script and the number of processes of the group which were still running
+        """
+        killed_processes = self._group_size(process.pid)
+        self._signal_group(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.script_to_execute_kill_grace
+        # Keep what the processes write while they stop
+        _, rusage = self._stream_output(process, output, deadline)
+        # The other processes of the group get the rest of the grace period
+        while rusage is not None and self._group_size(process.pid) > 0 and self._remaining_time(deadline) > 0:
+            time.sleep(EXIT_POLL_INTERVAL)
+        if rusage is None or self._group_size(process.pid) > 0:
+            self._signal_group(process.pid, signal.SIGKILL)
+        if rusage is None:
+            _, status, rusage = self._wait4(process, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._drain(process.stdout.fileno(), output, decoder)
+        output.write(decoder.decode(b'', final=True))
+        return rusage, killed_processes
+
+    def _signal_group(self, process_group, signal_number):
+        try:
+            os.killpg(process_group, signal_number)
+        except ProcessLookupError:
+            pass
+
+    def _group_size(self, process_group):
+        """Number of running processes in the process group, the zombies are not counted"""
+        size = 0
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join('/proc', pid, 'stat'), 'r') as f:
+                    # pid (command) state ppid pgrp ..., the command may contain spaces and parentheses
+                    state, _, pgrp = f.read().rsplit(')', 1)[1].split()[:3]
+            except (OSError, IndexError):
+                continue
+            if int(pgrp) == process_group and state != 'Z':
+                size += 1
+        return size
 
     def _is_log_needed(self):
         return self.log_path is not None
 
+    def _is_shipping_needed(self):
+        return self.log_ship is not None
+
+    def _is_history_needed(self):
+        return self.history_path is not None
+
+    def _is_metrics_needed(self):
+        return self.metrics_textfile is not None or self.metrics_statsd is not None
+
     def _is_email_needed(self):
         return self.email_address is not None
 
-    def _write_log(self, script_output):
-        with open(self.log_path, 'a', encoding='utf-8') as log:
-            log.write(script_output)
-
-    def _send_email(self, script_exit_code, script_output):
-        if self.email_only_on_fail and script_exit_code == 0:
+    def _send_email(self, script_exit_code, email_body, run):
+        notification, alert = None, None
+        if self.email_dedup is not None:
+            notification, alert = self._update_alert(script_exit_code, email_body.getvalue(), run['start'])
+            if notification == 'suppressed':
+                return
+        if self.email_only_on_fail and script_exit_code == 0 and notification != 'recovered':
+            return
+        if self._is_digest_needed(script_exit_code):
+            self._add_to_digest(script_exit_code, email_body.getvalue(), run['start'], run['duration'])
+            self._mark_alert_sent(notification, alert, run['start'])
+            self.flush_digest()
             return
         subject = "[Cron : OK]" if script_exit_code == 0 else "[Cron : FAIL]"
-        msg = MIMEText(script_output)
+        email_send_start = time.monotonic()
+        usage = run['usage'] if self.email_resource_usage else None
+        msg = self._email_content(email_body, usage)
         hostname = os.uname()[1]
         msg['Subject'] = "{0} <{1}> : {2}".format(subject, hostname, self.script_to_execute)
+        if run.get('limit_exceeded') is not None:
+            msg.replace_header('Subject', "{0} (limit exceeded: {1})".format(msg['Subject'], run['limit_exceeded']))
+        if notification == 'reminder':
+            msg.replace_header('Subject', "{0} (failed {1} times since {2})".format(
+                msg['Subject'], alert['count'], time.strftime('%Y-%m-%d %H:%M', time.localtime(alert['first_seen']))))
+        elif notification == 'recovered':
+            msg.replace_header('Subject', "{0} (recovered after {1} failures)".format(msg['Subject'], alert['count']))
+        if usage is not None:
+            msg.replace_header('Subject', "{0} ({1:.1f}s, cpu {2:.2f}s, {3} MB)".format(
+                msg['Subject'], usage['wall_time'], usage['user_time'] + usage['system_time'], usage['max_rss_kb'] // 1024))
         msg['From'] = 'custom_cron'
         msg['To'] = self.email_address
+        self._deliver_email(msg)
+        self._mark_alert_sent(notification, alert, run['start'])
+        run['email_send_time'] = time.monotonic() - email_send_start
+
+    def _update_alert(self, script_exit_code, script_output, start_time):
+        alerts = AlertCache(self.email_dedup, self.email_reminder_interval, self.email_dedup_ttl)
+        fingerprint = None if script_exit_code == 0 else alerts.fingerprint(script_exit_code, script_output)
+        return alerts.update(self._alert_key(), fingerprint, start_time)
+
+    def _mark_alert_sent(self, notification, alert, start_time):
+        # Only once the email is delivered or queued, a failed delivery is tried again on the next failure
+        if notification in ('new', 'reminder'):
+            alerts = AlertCache(self.email_dedup, self.email_reminder_interval, self.email_dedup_ttl)
+            alerts.mark_sent(self._alert_key(), alert['fingerprint'], start_time)
+
+    def _alert_key(self):
+        return ' '.join([self.script_to_execute or ''] + self.script_to_execute_args)
+
+    def _email_content(self, email_body, usage):
+        from email.mime.application import MIMEApplication
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        body = email_body.getvalue()
+        if usage is not None:
+            body += self._format_usage(usage)
+        if self.email_attach_above is None or email_body.size <= self.email_attach_above:
+            return MIMEText(body)
+        if self.email_full_output == 'log' and self.log_path is not None:
+            reference = "\nThe full output ({0} characters) is in {1} on {2}\n".format(
+                email_body.size, self.log_path, os.uname()[1])
+            return MIMEText(body + reference)
+        msg = MIMEMultipart()
+        msg.attach(MIMEText(body))
+        attachment = MIMEApplication(email_body.compressed_output(), 'gzip')
+        attachment.add_header('Content-Disposition', 'attachment', filename='output.txt.gz')
+        msg.attach(attachment)
+        return msg
+
+    def _format_usage(self, usage):
+        text = ("\n--\nWall time : {wall_time:.3f}s\nCPU time : user {user_time:.3f}s, system {system_time:.3f}s\n"
+                "Max RSS : {max_rss_kb} KB\nBlock I/O : {block_input} in, {block_output} out\n"
+                "Context switches : {voluntary_switches} voluntary, {involuntary_switches} involuntary\n").format(**usage)
+        if usage['killed_processes'] > 0:
+            text += "Killed on timeout : {0} processes\n".format(usage['killed_processes'])
+        return text
+
+    def _is_digest_needed(self, script_exit_code):
+        if self.email_digest is None:
+            return False
+        return script_exit_code == 0 or not self.email_digest_failures_immediately
+
+    def _add_to_digest(self, script_exit_code, script_output, start_time, duration):
+        record = {
+            'time': start_time,
+            'host': os.uname()[1],
+            'script': self.script_to_execute,
+            'exit_code': script_exit_code,
+            'duration': duration,
+            'output': script_output[:DIGEST_OUTPUT_MAX_SIZE],
+            'truncated': len(script_output) > DIGEST_OUTPUT_MAX_SIZE,
+        }
+        digest_spool = DigestSpool(self.email_digest)
+        for recipient in self.email_address.split(','):
+            digest_spool.add(recipient, record)
+
+    def flush_digest(self):
+        """Send one email per recipient whose digest window is over"""
+        if self.email_digest is None:
+            return
+        digest_spool = DigestSpool(self.email_digest)
+        for recipient in digest_spool.due(self.email_digest_interval):
+            digest_spool.flush(recipient, lambda records: self._deliver_email(self._digest_email(recipient, records)))
+
+    def _digest_email(self, recipient, records):
+        import datetime
+        from email.mime.text import MIMEText
+        failed = len([record for record in records if record['exit_code'] != 0])
+        subject = "[Cron : OK]" if failed == 0 else "[Cron : FAIL]"
+        hostnames = sorted(set(record['host'] for record in records))
+        summary = "{0} executions".format(len(records))
+        if failed > 0:
+            summary += ", {0} failed".format(failed)
+        body = []
+        for record in records:
+            status = "[Cron : OK]" if record['exit_code'] == 0 else "[Cron : FAIL]"
+            body.append("{0} {1} <{2}> : {3} (exit code {4}, {5:.1f}s)\n{6}{7}".format(
+                status, datetime.datetime.fromtimestamp(record['time']).strftime('%Y-%m-%d %H:%M:%S'),
+                record['host'], record['script'], record['exit_code'], record['duration'], record['output'],
+                "[... output truncated ...]\n" if record['truncated'] else ""))
+        msg = MIMEText('\n'.join(body))
+        msg['Subject'] = "{0} <{1}> : {2}".format(subject, ','.join(hostnames), summary)
+        msg['From'] = 'custom_cron'
+        msg['To'] = recipient
+        return msg
+
+    def _deliver_email(self, msg):
+        to_addrs = msg['To'].split(',')
+        if self.email_outbox is not None:
+            self._queue_email(to_addrs, msg)
+            return
+        if self.resources is not None:
+            smtp_pool = self.resources.smtp_pool(self.smtp_connection, self._connect_to_smtp)
+            smtp_pool.sendmail(to_addrs, msg.as_string())
+            return
         smtp_connection = self._connect_to_smtp()
-        smtp_connection.sendmail('custom_cron', self.email_address.split(','), msg.as_string())
+        smtp_connection.sendmail('custom_cron', to_addrs, msg.as_string())
         smtp_connection.quit()
 
+    def _queue_email(self, to_addrs, msg):
+        outbox = Outbox(self.email_outbox)
+        outbox.put(to_addrs, msg.as_string())
+        if self.resources is not None:
+            smtp_pool = self.resources.smtp_pool(self.smtp_connection, self._connect_to_smtp)
+            self.resources.drain_in_background(outbox, smtp_pool)
+            return
+        # Deliver from a detached sender so the wrapper returns right away. A new interpreter rather than a fork,
+        # the jobs run in threads, and without the standard streams of the wrapper which cron reads until their end
+        import json
+        sender = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'drain_outbox'], stdin=subprocess.PIPE,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        # The SMTP password is not given on the command line, visible to every user
+        sender.stdin.write(json.dumps({'outbox': self.email_outbox, 'smtp_connection': self.smtp_connection}).encode('utf-8'))
+        sender.stdin.close()
+
+    def drain_outbox(self):
+        """Deliver the emails of the outbox, run by the detached sender until the postponed emails are sent"""
+        outbox = Outbox(self.email_outbox)
+        smtp_pool = SMTPConnectionPool(self._connect_to_smtp)
+        deadline = time.monotonic() + Outbox.SENDER_MAX_TIME
+        try:
+            with open(os.path.join(self.email_outbox, '.sender'), 'a') as sender_lock:
+                try:
+                    fcntl.flock(sender_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    retrying = True
+                except BlockingIOError:
+                    # An other sender waits for the postponed emails, this one only sends the emails ready now
+                    retrying = False
+                while True:
+                    outbox.drain(smtp_pool)
+                    next_attempt = outbox.next_attempt()
+                    if not retrying or next_attempt is None or time.monotonic() >= deadline:
+                        return
+                    delay = min(next_attempt - time.time(), deadline - time.monotonic())
+                    time.sleep(max(delay, Outbox.SENDER_MIN_SLEEP))
+        finally:
+            smtp_pool.close()
+
     def _connect_to_smtp(self):
+        from smtplib import SMTP, SMTPNotSupportedError
         smtp_ten_minutes_timeout = 10*60
         smtp_connection = SMTP(self.smtp_connection['host'], self.smtp_connection['port'], smtp_ten_minutes_timeout)
         smtp_connection.ehlo()
@@ -138,6 +955,2224 @@ class CustomCron(object):
         return smtp_connection
 
 
+class ConfigurationLoader(object):
+    """Merge the configuration files into validated sections of typed values, parsing each file only once
+
+    The configuration is a file or a conf.d directory whose *.ini files are read in name order, a file can
+    include such a directory with "[include] directory = conf.d". The compiled sections of every file are kept
+    with its modification time and size, in memory for the next load and in the cache file when given,
+    so a load only parses the new and changed files.
+    """
+
+    CACHE_VERSION = 1
+    SCHEMA = {
+        'include': {'directory': str},
+        'log': {'path': str, 'format': ('raw', 'framed', 'json'), 'max_size': int, 'rotate_every': int,
+                'backups': int, 'compress': bool},
+        'shipping': {'target': str, 'spool': str, 'spool_max_size': int},
+        'history': {'path': str, 'retention_days': int},
+        'metrics': {'textfile': str, 'statsd': str, 'prefix': str},
+        'email': {'smtp_host': str, 'smtp_port': str, 'smtp_login': str, 'smtp_password': str, 'to': str,
+                  'only_on_fail': bool, 'outbox': str, 'digest': str, 'digest_interval': int,
+                  'digest_failures_immediately': bool, 'max_body_size': int, 'body_lines': int, 'attach_above': int,
+                  'full_output': ('attach', 'log'), 'resource_usage': bool, 'dedup': str, 'reminder_interval': int,
+                  'dedup_ttl': int},
+        'script': {'path': str, 'timeout': int, 'kill_grace': int, 'arguments': str, 'stats_file': str, 'splay': int, 'slot': str,
+                   'nice': int, 'ionice': str, 'cpu_affinity': str, 'limit_cpu': int, 'limit_memory': int, 'limit_files': int,
+                   'limit_file_size': int},
+        'python': {'preload': str},
+        'workers': {'max_parallel': int, 'max_load': float},
+        # Every other option of [slots] is the size of the slot of this name
+        'slots': {'directory': str, '*': int},
+        'lease': {'backend': str, 'duration': int, 'window': int},
+        'job:': {'path': str, 'arguments': str, 'timeout': int, 'log': str, 'email_to': str, 'only_on_fail': bool,
+                 'slot': str},
+    }
+
+    def __init__(self, path, cache_path=None):
+        self.path = path
+        self.cache_path = cache_path
+        self.parsed_paths = []
+        self._files = None
+
+    def load(self):
+        """Return the merged sections, only the files changed since the previous load or the cache are parsed"""
+        if self._files is None:
+            self._files = self._read_cache()
+        files = {}
+        config = {}
+        job_paths = {}
+        self.parsed_paths = []
+        for path in self._configuration_paths(self.path):
+            sections = self._compiled_sections(path, files)
+            self._merge(config, job_paths, path, sections)
+            if "include" not in sections:
+                continue
+            directory = os.path.join(os.path.dirname(path), sections["include"]["directory"])
+            for included_path in self._configuration_paths(directory):
+                included_sections = self._compiled_sections(included_path, files)
+                if "include" in included_sections:
+                    raise ValueError("Nested include in {0}".format(included_path))
+                self._merge(config, job_paths, included_path, included_sections)
+        if files != self._files:
+            self._files = files
+            self._write_cache()
+        return config
+
+    def _configuration_paths(self, path):
+        if os.path.isdir(path):
+            return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.ini'))
+        return [path] if os.path.isfile(path) else []
+
+    def _compiled_sections(self, path, files):
+        stat = os.stat(path)
+        compiled = self._files.get(path)
+        if compiled is None or compiled[:2] != [stat.st_mtime_ns, stat.st_size]:
+            compiled = [stat.st_mtime_ns, stat.st_size, self._compile(path)]
+            self.parsed_paths.append(path)
+        files[path] = compiled
+        return compiled[2]
+
+    def _compile(self, path):
+        import configparser
+        parser = configparser.ConfigParser()
+        sections = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                parser.read_file(f)
+            for name in parser.sections():
+                schema = self.SCHEMA.get("job:" if name.startswith("job:") else name)
+                if schema is None:
+                    raise ValueError("Unknown section [{0}] in {1}".format(name, path))
+                sections[name] = dict((key, self._value(parser[name], key, schema, path)) for key in parser[name])
+        except configparser.Error as e:
+            raise ValueError("Invalid configuration file {0} : {1}".format(path, e))
+        return sections
+
+    def _value(self, section, key, schema, path):
+        value_type = schema.get(key, schema.get('*'))
+        try:
+            if value_type is None:
+                raise ValueError("unknown option")
+            if value_type is int:
+                return section.getint(key)
+            if value_type is float:
+                return section.getfloat(key)
+            if value_type is bool:
+                return section.getboolean(key)
+            value = section[key]
+            if isinstance(value_type, tuple) and value not in value_type:
+                raise ValueError("{0} is not one of {1}".format(value, ', '.join(value_type)))
+            return value
+        except ValueError as e:
+            raise ValueError("Invalid {0} in section [{1}] of {2} : {3}".format(key, section.name, path, e))
+
+    def _merge(self, config, job_paths, path, sections):
+        for name, values in sections.items():
+            if name.startswith("job:"):
+                if name in job_paths:
+                    raise ValueError("Job {0} defined in {1} and {2}".format(name[len("job:"):], job_paths[name], path))
+                job_paths[name] = path
+                config[name] = dict(values)
+            else:
+                config.setdefault(name, {}).update(values)
+
+    def _read_cache(self):
+        import marshal
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path, 'rb') as f:
+                cache = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return {}
+        if not isinstance(cache, dict) or cache.get('version') != self.CACHE_VERSION:
+            return {}
+        return cache['files']
+
+    def _write_cache(self):
+        import marshal
+        if self.cache_path is None:
+            return
+        # The cache only saves the parsing, a cache which cannot be written is not an error
+        tmp_path = "{0}.{1}.tmp".format(self.cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                marshal.dump({'version': self.CACHE_VERSION, 'files': self._files}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class ResourceControls(object):
+    """Priority, I/O priority, CPU affinity and resource limits applied by the worker of the fork server"""
+
+    LIMITS = ('limit_cpu', 'limit_memory', 'limit_files', 'limit_file_size')
+    RLIMITS = {'limit_cpu': 'RLIMIT_CPU', 'limit_memory': 'RLIMIT_AS', 'limit_files': 'RLIMIT_NOFILE',
+               'limit_file_size': 'RLIMIT_FSIZE'}
+    IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+    # ioprio_set has no wrapper in the libc nor in Python
+    IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'aarch64': 30, 'i386': 289, 'i686': 289, 'armv7l': 314, 'ppc64le': 273,
+                           's390x': 282}
+
+    def __init__(self, nice=None, ionice=None, cpu_affinity=None, limits=None):
+        self.nice = nice
+        self.ionice = ionice
+        self.cpu_affinity = cpu_affinity
+        self.limits = dict((limit, value) for limit, value in (limits or {}).items() if value is not None)
+        self._rlimits = []
+        self._setrlimit = None
+        self._ioprio_set = None
+        if self.limits:
+            import resource
+            self._setrlimit = resource.setrlimit
+            for limit, value in sorted(self.limits.items()):
+                rlimit = getattr(resource, self.RLIMITS[limit])
+                _, hard = resource.getrlimit(rlimit)
+                # The CPU time over the soft limit gives a SIGXCPU, one more second a SIGKILL
+                soft_limit = value
+                hard_limit = value + 1 if limit == 'limit_cpu' else value
+                if hard != resource.RLIM_INFINITY:
+                    soft_limit, hard_limit = min(soft_limit, hard), min(hard_limit, hard)
+                self._rlimits.append((rlimit, (soft_limit, hard_limit)))
+        if self.ionice is not None:
+            import ctypes
+            machine = os.uname().machine
+            if machine not in self.IOPRIO_SET_SYSCALLS:
+                raise ValueError("ionice is not supported on {0}".format(machine))
+            self._ioprio_set = (ctypes.CDLL(None, use_errno=True).syscall, self.IOPRIO_SET_SYSCALLS[machine])
+
+    @classmethod
+    def parse_ionice(cls, ionice):
+        """Return the ioprio value of CLASS[:LEVEL], the class being a name or its number"""
+        io_class, _, level = ionice.partition(':')
+        io_class = cls.IONICE_CLASSES.get(io_class, int(io_class) if io_class.isdigit() else None)
+        if io_class not in cls.IONICE_CLASSES.values() or (level and not (level.isdigit() and int(level) <= 7)):
+            raise ValueError("Invalid ionice : {0}".format(ionice))
+        level = int(level) if level else (0 if io_class == cls.IONICE_CLASSES['idle'] else 4)
+        return io_class << 13 | level
+
+    @classmethod
+    def parse_cpu_affinity(cls, cpu_affinity):
+        """Return the set of CPUs of a list like 0-3,6"""
+        cpus = set()
+        try:
+            for cpu_range in cpu_affinity.split(','):
+                first, _, last = cpu_range.partition('-')
+                cpus.update(range(int(first), int(last or first) + 1))
+        except ValueError:
+            raise ValueError("Invalid cpu_affinity : {0}".format(cpu_affinity))
+        if not cpus:
+            raise ValueError("Invalid cpu_affinity : {0}".format(cpu_affinity))
+        return cpus
+
+    def apply(self):
+        # Runs in the worker of the fork server : everything is prepared by the constructor, nothing is imported
+        if self.nice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+        if self._ioprio_set is not None:
+            syscall, number = self._ioprio_set
+            # IOPRIO_WHO_PROCESS, the calling process
+            if syscall(number, 1, 0, self.ionice) != 0:
+                raise OSError("ioprio_set failed")
+        if self.cpu_affinity is not None:
+            os.sched_setaffinity(0, self.cpu_affinity)
+        for rlimit, values in self._rlimits:
+            self._setrlimit(rlimit, values)
+
+    @classmethod
+    def exceeded_limit(cls, limits, exit_code, usage, limit_errors):
+        """Name of the limit which stopped the script, from the signal which killed it or the errors in its output"""
+        if exit_code == 0:
+            return None
+        # The script is killed by the signal, or the shell running the command exits with 128 + signal
+        signals = [-exit_code, exit_code - 128]
+        if 'limit_cpu' in limits:
+            cpu_time = usage['user_time'] + usage['system_time']
+            if signal.SIGXCPU in signals or (signal.SIGKILL in signals and cpu_time >= limits['limit_cpu']):
+                return 'cpu'
+        if 'limit_file_size' in limits and signal.SIGXFSZ in signals:
+            return 'file_size'
+        if limit_errors is not None:
+            return limit_errors.exceeded
+        return None
+
+
+class LimitErrorSink(object):
+    """Look for the errors given by the memory and open files limits in the output"""
+
+    ERRORS = [
+        ('memory', r'Cannot allocate memory|MemoryError|[Oo]ut of memory|bad_alloc'),
+        ('files', r'Too many open files'),
+    ]
+
+    def __init__(self):
+        self.exceeded = None
+
+    def write(self, text):
+        if self.exceeded is not None:
+            return
+        for limit, pattern in self.ERRORS:
+            if re.search(pattern, text):
+                self.exceeded = limit
+                return
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ForkServer(object):
+    """Single-threaded process forking the workers of the Python entry points and of the scripts with resource controls
+
+    The server is forked from Custom Cron and waits for requests on a Unix socket. A request passes the write end
+    of the output pipe and a reply socket with SCM_RIGHTS, the server forks a worker in its own session which
+    applies the resource controls then calls MODULE:FUNCTION like a console script or executes the script.
+    The server replies with the pid of the worker and later its wait status. A Python worker skips the startup
+    of an interpreter and the imports of the preloaded modules. The controls are applied out of the threads of
+    Custom Cron, where a preexec_fn is not safe.
+    """
+
+    REQUEST_MAX_SIZE = 1024 * 1024
+
+    def __init__(self, preload):
+        self.preload = list(preload)
+        self.pid = None
+        self._socket = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        import socket
+        client_socket, server_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        pid = os.fork()
+        if pid == 0:
+            client_socket.close()
+            try:
+                self._serve(server_socket)
+            finally:
+                os._exit(0)
+        server_socket.close()
+        self.pid = pid
+        self._socket = client_socket
+
+    def run(self, script, args, controls, env):
+        """Return the ForkedProcess executing the script, or calling the python:MODULE:FUNCTION entry point
+
+        The controls are the plain settings of the ResourceControls applied by the worker.
+        """
+        import json
+        import socket
+        if self._socket is None:
+            self.start()
+        request = json.dumps({
+            'script': script,
+            'args': args,
+            'env': env,
+            'controls': controls,
+        }).encode('utf-8')
+        read_fd, write_fd = os.pipe()
+        reply, server_reply = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            with self._lock:
+                socket.send_fds(self._socket, [request], [write_fd, server_reply.fileno()])
+        finally:
+            os.close(write_fd)
+            server_reply.close()
+        message = reply.recv(4096)
+        if not message:
+            os.close(read_fd)
+            reply.close()
+            raise OSError("Fork server stopped")
+        return ForkedProcess(json.loads(message)['pid'], os.fdopen(read_fd, 'rb'), reply)
+
+    def close(self):
+        if self._socket is not None:
+            # The server exits once the socket is closed
+            self._socket.close()
+            self._socket = None
+            os.waitpid(self.pid, 0)
+
+    def _serve(self, server_socket):
+        import importlib
+        import json
+        import socket
+        import traceback
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        for module in self.preload:
+            try:
+                importlib.import_module(module)
+            except Exception:
+                traceback.print_exc()
+        # The SIGCHLD of the workers wake up the select through the pipe
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_write, False)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(wakeup_write)
+        workers = {}
+        while True:
+            ready, _, _ = select.select([server_socket, wakeup_read], [], [])
+            if wakeup_read in ready:
+                os.read(wakeup_read, 4096)
+            if server_socket in ready:
+                message, fds, _, _ = socket.recv_fds(server_socket, self.REQUEST_MAX_SIZE, 2)
+                if not message:
+                    return
+                output_fd, reply_fd = fds
+                pid = os.fork()
+                if pid == 0:
+                    signal.set_wakeup_fd(-1)
+                    for fd in [server_socket.fileno(), wakeup_read, wakeup_write, reply_fd] + [
+                            worker.fileno() for worker in workers.values()]:
+                        os.close(fd)
+                    self._call(json.loads(message), output_fd)
+                os.close(output_fd)
+                workers[pid] = socket.socket(fileno=reply_fd)
+                workers[pid].send(json.dumps({'pid': pid}).encode('utf-8'))
+            for pid in list(workers):
+                done, status, rusage = os.wait4(pid, os.WNOHANG)
+                if done != 0:
+                    reply = workers.pop(pid)
+                    try:
+                        reply.send(json.dumps({'status': status, 'rusage': list(rusage)}).encode('utf-8'))
+                    except OSError:
+                        pass
+                    reply.close()
+
+    def _call(self, request, output_fd):
+        """Run in the worker, call the entry point or execute the script, then exit with its status like sys.exit"""
+        exit_code = 1
+        try:
+            os.setsid()
+            for signal_number in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGCHLD):
+                signal.signal(signal_number, signal.SIG_DFL)
+            os.dup2(output_fd, 1)
+            os.dup2(output_fd, 2)
+            os.close(output_fd)
+            sys.stdout = open(1, 'w', encoding='utf-8', errors='replace', closefd=False)
+            sys.stderr = open(2, 'w', encoding='utf-8', errors='replace', closefd=False, buffering=1)
+            controls = request['controls']
+            ResourceControls(controls['nice'], controls['ionice'],
+                             set(controls['cpu_affinity']) if controls['cpu_affinity'] is not None else None,
+                             controls['limits']).apply()
+            os.environ.update(request['env'])
+            if not request['script'].startswith(ENTRY_POINT_PREFIX):
+                self._exec(request['script'], request['args'])
+            entry_point = request['script'][len(ENTRY_POINT_PREFIX):]
+            exit_code = self._exit_code(self._entry_point(entry_point)(request['args']))
+        except SystemExit as e:
+            exit_code = self._exit_code(e.code)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(exit_code)
+
+    def _exec(self, script, args):
+        # Same state as a child of subprocess : default signals ignored by Python and only the standard streams
+        for signal_number in (signal.SIGPIPE, signal.SIGXFSZ):
+            signal.signal(signal_number, signal.SIG_DFL)
+        os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+        try:
+            os.execv(script, [script] + args)
+        except OSError as e:
+            sys.stderr.write("ERROR : Cannot execute {0} : {1}\n".format(script, e))
+            sys.exit(126)
+
+    def _entry_point(self, entry_point):
+        import importlib
+        module_name, _, function_name = entry_point.partition(':')
+        function = importlib.import_module(module_name)
+        for name in function_name.split('.'):
+            function = getattr(function, name)
+
+        def call(args):
+            sys.argv = [entry_point] + args
+            return function()
+        return call
+
+    def _exit_code(self, value):
+        if value is None:
+            return 0
+        if isinstance(value, int):
+            return value
+        sys.stderr.write("{0}\n".format(value))
+        return 1
+
+
+class ForkedProcess(object):
+    """Worker of the fork server, with the stdout and the wait4 of a child process"""
+
+    def __init__(self, pid, stdout, reply):
+        self.pid = pid
+        self.stdout = stdout
+        self.returncode = None
+        self._reply = reply
+
+    def exit_fd(self):
+        """Readable once the worker exited, like a pidfd"""
+        return self._reply.fileno()
+
+    def wait4(self, options):
+        """Same result as os.wait4, the wait status and resource usage are sent by the fork server"""
+        import json
+        import resource
+        if options & os.WNOHANG and not select.select([self._reply], [], [], 0)[0]:
+            return 0, 0, None
+        message = self._reply.recv(4096)
+        self._reply.close()
+        if not message:
+            raise ChildProcessError("Fork server stopped before worker {0}".format(self.pid))
+        result = json.loads(message)
+        return self.pid, result['status'], resource.struct_rusage(result['rusage'])
+
+
+class ScriptOutput(object):
+    """Fan out the output of the script to every sink as it arrives"""
+
+    def __init__(self):
+        self.sinks = []
+        # Number of bytes read from the script
+        self.size = 0
+
+    def add(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def write(self, text):
+        if not text:
+            return
+        for sink in self.sinks:
+            sink.write(text)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class ConsoleSink(object):
+    """Write the output on stdout, each line prefixed by the job name if any"""
+
+    _lock = threading.Lock()
+
+    def __init__(self, job_name=None):
+        self._prefix = "[{0}] ".format(job_name) if job_name is not None else None
+        self._pending = ''
+
+    def write(self, text):
+        if self._prefix is not None:
+            lines = (self._pending + text).split('\n')
+            self._pending = lines.pop()
+            if not lines:
+                return
+            text = ''.join(self._prefix + line + '\n' for line in lines)
+        with self._lock:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._pending:
+            self.write('\n')
+
+
+class LogSink(object):
+    """Buffer the output of an execution and append it to the log file
+
+    raw : the output as is
+    framed : the whole execution between a header and a footer, written at once at the end
+    json : one JSON record at the start, for each piece of output and at the end of the execution
+    """
+
+    FORMATS = ('raw', 'framed', 'json')
+
+    def __init__(self, log_file, log_format, run, buffer_size=LOG_BUFFER_SIZE):
+        self._log_file = log_file
+        self._format = log_format
+        self._run = run
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._buffered_size = 0
+        self._last_flush = time.monotonic()
+        self._ends_with_newline = True
+        self._framed_output = None
+        if self._format == 'framed':
+            import tempfile
+            self._framed_output = tempfile.SpooledTemporaryFile(max_size=buffer_size, mode='w+t', encoding='utf-8')
+        elif self._format == 'json':
+            self._log_file.append(self._json_record('start', time=run['start'], host=run['host'], script=run['script']))
+
+    def write(self, text):
+        self._ends_with_newline = text.endswith('\n')
+        if self._framed_output is not None:
+            self._framed_output.write(text)
+            return
+        self._buffer.append(text)
+        self._buffered_size += len(text)
+        if self._buffered_size >= self._buffer_size or time.monotonic() - self._last_flush >= OUTPUT_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        text = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered_size = 0
+        if self._format == 'json':
+            text = self._json_record('output', data=text)
+        self._log_file.append(text)
+
+    def finish(self):
+        """Write the end of the execution, once the exit code, duration and resource usage are in the run"""
+        self.flush()
+        run = self._run
+        if self._format == 'json':
+            self._log_file.append(self._json_record('end', exit_code=run['exit_code'], duration=round(run['duration'], 3),
+                                                    usage=run['usage']))
+        elif self._format == 'framed':
+            import datetime
+            self._framed_output.seek(0)
+            header = "=== {0} start {1} host {2} script {3} ===\n".format(
+                run['id'], datetime.datetime.fromtimestamp(run['start']).isoformat(timespec='seconds'),
+                run['host'], run['script'])
+            usage = ''
+            if run['usage'] is not None:
+                usage = " user {user_time:.3f}s system {system_time:.3f}s max rss {max_rss_kb} KB".format(**run['usage'])
+            footer = "{0}=== {1} end exit code {2} duration {3:.3f}s{4} ===\n".format(
+                '' if self._ends_with_newline else '\n', run['id'], run['exit_code'], run['duration'], usage)
+            self._log_file.append_all([header], self._framed_output, [footer])
+
+    def close(self):
+        self.flush()
+        if self._framed_output is not None:
+            self._framed_output.close()
+        self._log_file.release()
+
+    def _json_record(self, event, **fields):
+        import json
+        record = {'run': self._run['id'], 'event': event}
+        record.update(fields)
+        return json.dumps(record) + '\n'
+
+
+class LogFile(object):
+    """Log file shared by many executions, appended under an exclusive lock and rotated by size or age
+
+    The rotated files are suffixed by their rotation time and compressed in background.
+    """
+
+    def __init__(self, path, max_size=None, rotate_every=None, backups=5, compress=True, keep_open=True):
+        self.path = path
+        self.max_size = max_size
+        self.rotate_every = rotate_every
+        self.backups = backups
+        self.compress = compress
+        self._keep_open = keep_open
+        self._log = None
+        self._lock = threading.Lock()
+        self._compressions = []
+
+    def append(self, text):
+        self.append_all([text])
+
+    def append_all(self, *parts):
+        """Append every part (a list of strings or a file) as a single record"""
+        with self._lock, open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._rotate_if_needed()
+            log = self._open()
+            for part in parts:
+                for text in iter(lambda: part.read(OUTPUT_CHUNK_SIZE), '') if hasattr(part, 'read') else part:
+                    log.write(text)
+            log.flush()
+
+    def release(self):
+        if not self._keep_open:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def _open(self):
+        # An other process may have rotated the log since it was opened
+        if self._log is not None and not self._is_current_file():
+            self._log.close()
+            self._log = None
+        if self._log is None:
+            self._log = open(self.path, 'a', encoding='utf-8')
+        return self._log
+
+    def _is_current_file(self):
+        try:
+            return os.path.samestat(os.fstat(self._log.fileno()), os.stat(self.path))
+        except FileNotFoundError:
+            return False
+
+    def _rotate_if_needed(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        rotation_stamp = self.path + '.rotated'
+        if self.rotate_every is not None and not os.path.exists(rotation_stamp):
+            open(rotation_stamp, 'a').close()
+        too_big = self.max_size is not None and stat.st_size >= self.max_size
+        too_old = self.rotate_every is not None and time.time() - os.stat(rotation_stamp).st_mtime >= self.rotate_every
+        if not too_big and not too_old:
+            return
+        import datetime
+        rotated_path = "{0}.{1}".format(self.path, datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+        os.rename(self.path, rotated_path)
+        if self.rotate_every is not None:
+            os.utime(rotation_stamp)
+        if self.compress:
+            compression = threading.Thread(target=self._compress, args=(rotated_path,))
+            compression.start()
+            self._compressions.append(compression)
+        self._remove_old_backups()
+
+    def _compress(self, rotated_path):
+        import gzip
+        import shutil
+        try:
+            with open(rotated_path, 'rb') as rotated, gzip.open(rotated_path + '.gz.tmp', 'wb') as compressed:
+                shutil.copyfileobj(rotated, compressed)
+            os.rename(rotated_path + '.gz.tmp', rotated_path + '.gz')
+            os.remove(rotated_path)
+        except FileNotFoundError:
+            # The backup has been removed meanwhile
+            if os.path.exists(rotated_path + '.gz.tmp'):
+                os.remove(rotated_path + '.gz.tmp')
+
+    def _remove_old_backups(self):
+        import glob
+        backups = {}
+        for backup_path in glob.glob(glob.escape(self.path) + '.[0-9]*'):
+            if backup_path.endswith('.tmp'):
+                continue
+            backups.setdefault(backup_path[:-3] if backup_path.endswith('.gz') else backup_path, []).append(backup_path)
+        for rotated_path in sorted(backups)[:-self.backups] if self.backups > 0 else sorted(backups):
+            for backup_path in backups[rotated_path]:
+                try:
+                    os.remove(backup_path)
+                except FileNotFoundError:
+                    pass
+
+    def wait_for_compressions(self):
+        for compression in self._compressions:
+            compression.join()
+        self._compressions = []
+
+
+class LogShipper(object):
+    """Send the records of the executions to syslog or to a TCP or UDP collector, one JSON record per line
+
+    The records are sent by batch over a single connection, with the output compressed when it is large.
+    The records which cannot be sent are spilled in the spool directory, within spool_max_size bytes by dropping
+    the oldest ones, and sent again before the next records. With a batch interval (daemon mode),
+    the records are gathered and sent by a background thread.
+    """
+
+    BATCH_SIZE = 100
+    COMPRESS_ABOVE = 1024
+    CONNECT_TIMEOUT = 2
+    UDP_MAX_DATAGRAM = 60000
+    SYSLOG_PATH = '/dev/log'
+
+    def __init__(self, target, spool_path=None, spool_max_size=SHIPPING_SPOOL_MAX_SIZE, batch_interval=None):
+        self.target = target
+        self.spool_path = spool_path
+        self.spool_max_size = spool_max_size
+        self.batch_interval = batch_interval
+        self.protocol, self.address = self._parse_target(target)
+        if self.spool_path is not None:
+            os.makedirs(self.spool_path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._records = []
+        self._sender = None
+        self._closed = threading.Event()
+
+    def ship(self, record):
+        import json
+        record = dict(record)
+        if len(record['output']) > self.COMPRESS_ABOVE:
+            import base64
+            import zlib
+            record['output'] = base64.b64encode(zlib.compress(record['output'].encode('utf-8'))).decode('ascii')
+            record['output_encoding'] = 'zlib+base64'
+        with self._lock:
+            self._records.append(json.dumps(record))
+            if self.batch_interval is not None and len(self._records) < self.BATCH_SIZE:
+                if self._sender is None:
+                    self._sender = threading.Thread(target=self._send_periodically, daemon=True)
+                    self._sender.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """Send the spilled records then the new ones, the records are spilled again on failure"""
+        with self._lock:
+            records, self._records = self._records, []
+        if self.spool_path is None:
+            self._send_or_drop(records)
+            return
+        with open(os.path.join(self.spool_path, '.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # An other process is sending the spilled records, only send the new ones
+                if not self._send_or_drop(records):
+                    self._spill(records)
+                return
+            spilled = self._spilled()
+            lines = [line for _, lines in spilled for line in lines] + records
+            if not self._send_or_drop(lines):
+                if records:
+                    self._spill(records)
+                return
+            for name, _ in spilled:
+                os.remove(os.path.join(self.spool_path, name))
+
+    def close(self):
+        self._closed.set()
+        if self._sender is not None:
+            self._sender.join()
+        self.flush()
+
+    def _send_periodically(self):
+        while not self._closed.wait(self.batch_interval):
+            self.flush()
+
+    def _send_or_drop(self, lines):
+        if not lines:
+            return True
+        try:
+            self._send(lines)
+            return True
+        except OSError:
+            return False
+
+    def _send(self, lines):
+        import socket
+        if self.protocol == 'tcp':
+            with socket.create_connection(self.address, timeout=self.CONNECT_TIMEOUT) as connection:
+                connection.sendall(''.join(line + '\n' for line in lines).encode('utf-8'))
+            return
+        family = socket.AF_UNIX if self.protocol == 'syslog' else socket.AF_INET
+        with socket.socket(family, socket.SOCK_DGRAM) as connection:
+            connection.settimeout(self.CONNECT_TIMEOUT)
+            connection.connect(self.address)
+            for datagram in self._datagrams(lines):
+                connection.send(datagram)
+
+    def _datagrams(self, lines):
+        import json
+        if self.protocol == 'syslog':
+            # user facility, error severity for the failures and info otherwise
+            for line in lines:
+                priority = 8 + (3 if json.loads(line)['exit_code'] != 0 else 6)
+                yield "<{0}>custom_cron[{1}]: {2}".format(priority, os.getpid(), line).encode('utf-8')
+            return
+        datagram = b''
+        for line in lines:
+            line = line.encode('utf-8') + b'\n'
+            if datagram and len(datagram) + len(line) > self.UDP_MAX_DATAGRAM:
+                yield datagram
+                datagram = b''
+            datagram += line
+        if datagram:
+            yield datagram
+
+    def _spill(self, records):
+        name = "{0}-{1}-{2}.jsonl".format(time.time_ns(), os.getpid(), threading.get_ident())
+        tmp_path = os.path.join(self.spool_path, '.' + name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(line + '\n' for line in records))
+        os.rename(tmp_path, os.path.join(self.spool_path, name))
+        # Bounded spool : the oldest records are dropped first
+        names = sorted(name for name in os.listdir(self.spool_path) if name.endswith('.jsonl'))
+        sizes = [os.path.getsize(os.path.join(self.spool_path, name)) for name in names]
+        while len(names) > 1 and sum(sizes) > self.spool_max_size:
+            os.remove(os.path.join(self.spool_path, names.pop(0)))
+            sizes.pop(0)
+
+    def _spilled(self):
+        spilled = []
+        for name in sorted(name for name in os.listdir(self.spool_path) if name.endswith('.jsonl')):
+            with open(os.path.join(self.spool_path, name), 'r', encoding='utf-8') as f:
+                spilled.append((name, [line.rstrip('\n') for line in f if line.strip()]))
+        return spilled
+
+    def _parse_target(self, target):
+        if target == 'syslog':
+            return 'syslog', self.SYSLOG_PATH
+        protocol, _, address = target.partition('://')
+        if protocol == 'syslog' and address:
+            return 'syslog', address
+        host, _, port = address.rpartition(':')
+        if protocol not in ('tcp', 'udp') or not host or not port.isdigit():
+            raise ValueError("Invalid log shipping target : {0}".format(target))
+        return protocol, (host, int(port))
+
+
+class EmailBodySink(object):
+    """Keep the beginning and the end of the output, up to max_size characters and body_lines lines each
+
+    When spool is set, the full output is also compressed on the fly into a temporary file
+    so it can be attached to the email.
+    """
+
+    def __init__(self, max_size, body_lines=None, spool=False):
+        self.size = 0
+        self.lines = 0
+        self._head_max_size = max_size - max_size // 2
+        self._tail_max_size = max_size // 2
+        self._body_lines = body_lines
+        self._head = []
+        self._head_size = 0
+        self._head_lines = 0
+        self._head_full = False
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self._spool = None
+        self._compressed_spool = None
+        if spool:
+            import gzip
+            import tempfile
+            self._spool = tempfile.TemporaryFile()
+            self._compressed_spool = gzip.GzipFile(fileobj=self._spool, mode='wb')
+
+    def write(self, text):
+        self.size += len(text)
+        self.lines += text.count('\n')
+        if self._compressed_spool is not None:
+            self._compressed_spool.write(text.encode('utf-8'))
+        if not self._head_full:
+            text = self._write_head(text)
+        if text:
+            self._write_tail(text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._compressed_spool is not None:
+            self._compressed_spool.close()
+
+    def discard(self):
+        if self._spool is not None:
+            self._spool.close()
+
+    def compressed_output(self):
+        self._spool.seek(0)
+        return self._spool.read()
+
+    def getvalue(self):
+        head = ''.join(self._head)
+        tail = ''.join(self._tail)
+        if self._body_lines is not None:
+            tail = ''.join(tail.splitlines(keepends=True)[-self._body_lines:]) if self._body_lines > 0 else ''
+        elided_size = self.size - len(head) - len(tail)
+        if elided_size == 0:
+            return head + tail
+        elided_lines = self.lines - head.count('\n') - tail.count('\n')
+        if head and not head.endswith('\n'):
+            head += '\n'
+        return "{0}[... {1} lines ({2} characters) elided ...]\n{3}".format(head, elided_lines, elided_size, tail)
+
+    def _write_head(self, text):
+        kept = text[:self._head_max_size - self._head_size]
+        if self._body_lines is not None:
+            kept = self._first_lines(kept, self._body_lines - self._head_lines)
+        self._head.append(kept)
+        self._head_size += len(kept)
+        self._head_lines += kept.count('\n')
+        if len(kept) < len(text):
+            self._head_full = True
+        return text[len(kept):]
+
+    def _first_lines(self, text, count):
+        if count <= 0:
+            return ''
+        newline_position = -1
+        for _ in range(count):
+            newline_position = text.find('\n', newline_position + 1)
+            if newline_position < 0:
+                return text
+        return text[:newline_position + 1]
+
+    def _write_tail(self, text):
+        self._tail.append(text)
+        self._tail_size += len(text)
+        while self._tail and self._tail_size - len(self._tail[0]) >= self._tail_max_size:
+            self._tail_size -= len(self._tail.popleft())
+        if self._tail_size > self._tail_max_size:
+            overflow = self._tail_size - self._tail_max_size
+            self._tail[0] = self._tail[0][overflow:]
+            self._tail_size -= overflow
+
+
+class SMTPConnectionPool(object):
+    """Authenticated SMTP connections reused between the emails, checked with NOOP before reuse"""
+
+    def __init__(self, connect, max_idle=2, idle_timeout=5*60):
+        self._connect = connect
+        self._max_idle = max_idle
+        self._idle_timeout = idle_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                smtp_connection, released_at = self._idle.pop()
+            if time.monotonic() - released_at < self._idle_timeout and self._is_alive(smtp_connection):
+                return smtp_connection
+            self.discard(smtp_connection)
+        return self._connect()
+
+    def release(self, smtp_connection):
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append((smtp_connection, time.monotonic()))
+                return
+        self.discard(smtp_connection)
+
+    def discard(self, smtp_connection):
+        try:
+            smtp_connection.quit()
+        except Exception:
+            pass
+
+    def sendmail(self, to_addrs, message):
+        from smtplib import SMTPServerDisconnected
+        smtp_connection = self.acquire()
+        try:
+            try:
+                smtp_connection.sendmail('custom_cron', to_addrs, message)
+            except SMTPServerDisconnected:
+                smtp_connection = self._connect()
+                smtp_connection.sendmail('custom_cron', to_addrs, message)
+        except Exception:
+            self.discard(smtp_connection)
+            raise
+        self.release(smtp_connection)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for smtp_connection, _ in idle:
+            self.discard(smtp_connection)
+
+    def _is_alive(self, smtp_connection):
+        try:
+            return smtp_connection.noop()[0] == 250
+        except Exception:
+            return False
+
+
+class Outbox(object):
+    """On-disk queue of the emails waiting to be delivered
+
+    An email refused with a permanent 5xx error or still not sent after MAX_ATTEMPTS is moved to the failed
+    subdirectory, so it does not hold back the emails queued after it.
+    """
+
+    RETRY_BASE_DELAY = 30
+    RETRY_MAX_DELAY = 60*60
+    MAX_ATTEMPTS = 10
+    # The detached sender outlives the retries of an email, about 3 hours and a half
+    SENDER_MAX_TIME = 6*60*60
+    SENDER_MIN_SLEEP = 1
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def put(self, to_addrs, message):
+        name = "{0}-{1}-{2}.json".format(time.time_ns(), os.getpid(), threading.get_ident())
+        self._write(name, {'to': to_addrs, 'message': message, 'attempts': 0, 'next_attempt': 0})
+        return name
+
+    def pending(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.json'))
+
+    def next_attempt(self):
+        """Return the time of the earliest attempt of the pending emails, None if the outbox is empty"""
+        import json
+        next_attempt = None
+        for name in self.pending():
+            try:
+                with open(os.path.join(self.path, name), 'r', encoding='utf-8') as f:
+                    email = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if next_attempt is None or email['next_attempt'] < next_attempt:
+                next_attempt = email['next_attempt']
+        return next_attempt
+
+    def drain(self, smtp_pool, batch_size=100):
+        """Send the ready emails over a single SMTP session, returns the number of emails sent"""
+        with open(os.path.join(self.path, '.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # An other sender is already draining the outbox
+                return 0
+            sent = 0
+            while True:
+                batch = self._ready(batch_size)
+                if not batch:
+                    return sent
+                batch_sent, connected = self._send_batch(smtp_pool, batch)
+                sent += batch_sent
+                if not connected:
+                    return sent
+
+    def _send_batch(self, smtp_pool, batch):
+        """Return the number of emails sent and whether the SMTP session is still usable"""
+        from smtplib import SMTPException, SMTPRecipientsRefused, SMTPResponseException, SMTPServerDisconnected
+        try:
+            smtp_connection = smtp_pool.acquire()
+        except Exception:
+            for name, email in batch:
+                self._postpone(name, email, None)
+            return 0, False
+        sent = 0
+        for name, email in batch:
+            try:
+                smtp_connection.sendmail('custom_cron', email['to'], email['message'])
+            except SMTPRecipientsRefused as e:
+                codes = [code for code, _ in e.recipients.values()]
+                self._postpone(name, email, e, permanent=all(code >= 500 for code in codes))
+                continue
+            except SMTPResponseException as e:
+                self._postpone(name, email, e, permanent=e.smtp_code >= 500)
+                continue
+            except Exception as e:
+                self._postpone(name, email, e)
+                # SMTPException is an OSError too, but only a disconnection breaks the session
+                if isinstance(e, SMTPServerDisconnected) or (isinstance(e, OSError) and not isinstance(e, SMTPException)):
+                    # The emails not tried yet are sent by the next drain
+                    smtp_pool.discard(smtp_connection)
+                    return sent, False
+                continue
+            os.remove(os.path.join(self.path, name))
+            sent += 1
+        smtp_pool.release(smtp_connection)
+        return sent, True
+
+    def _ready(self, batch_size):
+        import json
+        batch = []
+        now = time.time()
+        for name in self.pending():
+            try:
+                with open(os.path.join(self.path, name), 'r', encoding='utf-8') as f:
+                    email = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if email['next_attempt'] <= now:
+                batch.append((name, email))
+                if len(batch) == batch_size:
+                    break
+        return batch
+
+    def _postpone(self, name, email, error, permanent=False):
+        email['attempts'] += 1
+        if error is not None:
+            email['error'] = str(error)
+        if permanent or email['attempts'] >= self.MAX_ATTEMPTS:
+            os.makedirs(os.path.join(self.path, 'failed'), exist_ok=True)
+            self._write(os.path.join('failed', name), email)
+            os.remove(os.path.join(self.path, name))
+            return
+        delay = min(self.RETRY_BASE_DELAY * 2 ** (email['attempts'] - 1), self.RETRY_MAX_DELAY)
+        email['next_attempt'] = time.time() + delay
+        self._write(name, email)
+
+    def _write(self, name, email):
+        import json
+        tmp_path = os.path.join(self.path, os.path.dirname(name), '.' + os.path.basename(name) + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(email, f)
+        os.rename(tmp_path, os.path.join(self.path, name))
+
+
+class DigestSpool(object):
+    """On-disk spool of the executions waiting to be sent in a digest, one file per recipient"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def add(self, recipient, record):
+        import json
+        record = dict(record, recipient=recipient)
+        spool_path = self._spool_path(recipient)
+        while True:
+            with open(spool_path, 'a', encoding='utf-8') as spool:
+                fcntl.flock(spool, fcntl.LOCK_EX)
+                # The spool may have been taken by a flush while waiting for the lock
+                if not self._is_same_file(spool, spool_path):
+                    continue
+                spool.write(json.dumps(record) + '\n')
+                return
+
+    def due(self, interval):
+        """Return the recipients whose digest window is over or whose last digest failed"""
+        import glob
+        import json
+        recipients = set()
+        now = time.time()
+        for spool_path in glob.glob(os.path.join(self.path, '*.spool')) + glob.glob(os.path.join(self.path, '*.sending')):
+            try:
+                with open(spool_path, 'r', encoding='utf-8') as spool:
+                    first_record = json.loads(spool.readline())
+            except (OSError, ValueError):
+                continue
+            if spool_path.endswith('.sending') or now - first_record['time'] >= interval:
+                recipients.add(first_record['recipient'])
+        return sorted(recipients)
+
+    def flush(self, recipient, send):
+        """Give every spooled record of the recipient to send, the records are kept if send fails"""
+        import json
+        with open(self._spool_path(recipient) + '.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # An other process is already sending this digest
+                return
+            self._take(recipient)
+            sending_paths = self._sending_paths(recipient)
+            records = []
+            for sending_path in sending_paths:
+                with open(sending_path, 'r', encoding='utf-8') as sending:
+                    records.extend(json.loads(line) for line in sending if line.strip())
+            if records:
+                send(sorted(records, key=lambda record: record['time']))
+            for sending_path in sending_paths:
+                os.remove(sending_path)
+
+    def _take(self, recipient):
+        spool_path = self._spool_path(recipient)
+        if not os.path.isfile(spool_path):
+            return
+        with open(spool_path, 'a', encoding='utf-8') as spool:
+            fcntl.flock(spool, fcntl.LOCK_EX)
+            os.rename(spool_path, "{0}.{1}.sending".format(spool_path, time.time_ns()))
+
+    def _sending_paths(self, recipient):
+        import glob
+        return sorted(glob.glob(glob.escape(self._spool_path(recipient)) + '.*.sending'))
+
+    def _spool_path(self, recipient):
+        import hashlib
+        return os.path.join(self.path, hashlib.sha1(recipient.encode('utf-8')).hexdigest() + '.spool')
+
+    def _is_same_file(self, spool, spool_path):
+        try:
+            return os.path.samestat(os.fstat(spool.fileno()), os.stat(spool_path))
+        except FileNotFoundError:
+            return False
+
+
+class AlertCache(object):
+    """Failures of the scripts already reported, so a script failing the same way is not reported on every execution
+
+    A failure is identified by the exit code and the output with its timestamps, hexadecimal ids and numbers masked.
+    The failures not seen again for ttl seconds are evicted, they are new again when they come back.
+    """
+
+    MASKS = [
+        (r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(?::\d{2}(?:[.,]\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?', '<time>'),
+        (r'\b(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun|Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\b', '<time>'),
+        (r'\b(?=[0-9a-fA-F]*[a-fA-F])(?=[0-9a-fA-F]*[0-9])[0-9a-fA-F]{8,}\b', '<id>'),
+        (r'\d+', '<n>'),
+    ]
+
+    def __init__(self, path, reminder_interval, ttl):
+        self.path = path
+        self.reminder_interval = reminder_interval
+        self.ttl = ttl
+
+    def fingerprint(self, exit_code, output):
+        import hashlib
+        for pattern, mask in self.MASKS:
+            output = re.sub(pattern, mask, output)
+        return hashlib.sha1("{0}\n{1}".format(exit_code, output).encode('utf-8')).hexdigest()
+
+    def update(self, key, fingerprint, now):
+        """Record an execution of the script, without fingerprint on success
+
+        Return the email to send ('new', 'reminder', 'recovered', 'suppressed' or None on a success after a success)
+        and the failure it is about, with its first time seen and its number of occurrences. A failure is 'new'
+        until mark_sent records that its email was sent.
+        """
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            alerts = dict((alert_key, alert) for alert_key, alert in self._load().items()
+                          if now - alert['last_seen'] < self.ttl)
+            alert = alerts.get(key)
+            if fingerprint is None:
+                notification = None if alert is None else 'recovered'
+                alerts.pop(key, None)
+            elif alert is None or alert['fingerprint'] != fingerprint:
+                alert = {'fingerprint': fingerprint, 'first_seen': now, 'last_seen': now, 'last_sent': None, 'count': 1}
+                alerts[key] = alert
+                notification = 'new'
+            else:
+                alert['count'] += 1
+                alert['last_seen'] = now
+                if alert['last_sent'] is None:
+                    notification = 'new'
+                elif now - alert['last_sent'] >= self.reminder_interval:
+                    notification = 'reminder'
+                else:
+                    notification = 'suppressed'
+            self._write(alerts)
+        return notification, alert
+
+    def mark_sent(self, key, fingerprint, now):
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            alerts = self._load()
+            if key in alerts and alerts[key]['fingerprint'] == fingerprint:
+                alerts[key]['last_sent'] = now
+                self._write(alerts)
+
+    def _load(self):
+        import json
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write(self, alerts):
+        import json
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(alerts, f)
+        os.replace(tmp_path, self.path)
+
+
+class HistoryStore(object):
+    """SQLite database of the past executions"""
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            run_id TEXT NOT NULL,
+            script TEXT,
+            host TEXT NOT NULL,
+            start REAL NOT NULL,
+            duration REAL NOT NULL,
+            exit_code INTEGER NOT NULL,
+            log_path TEXT,
+            output BLOB,
+            user_time REAL,
+            system_time REAL,
+            max_rss_kb INTEGER,
+            block_input INTEGER,
+            block_output INTEGER
+        )""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS runs_run_id ON runs (run_id)",
+        # The duration percentiles of a window are read from the index
+        "DROP INDEX IF EXISTS runs_start",
+        "CREATE INDEX IF NOT EXISTS runs_start_duration ON runs (start, duration)",
+        "CREATE INDEX IF NOT EXISTS runs_script_start ON runs (script, start, exit_code, duration)",
+        "CREATE INDEX IF NOT EXISTS runs_failures ON runs (script, start) WHERE exit_code != 0",
+    ]
+    USAGE_COLUMNS = [
+        ('user_time', 'REAL'),
+        ('system_time', 'REAL'),
+        ('max_rss_kb', 'INTEGER'),
+        ('block_input', 'INTEGER'),
+        ('block_output', 'INTEGER'),
+        ('killed_processes', 'INTEGER'),
+    ]
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            for statement in self.SCHEMA:
+                self._connection.execute(statement)
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(runs)")]
+            for column, column_type in self.USAGE_COLUMNS:
+                if column not in columns:
+                    self._connection.execute("ALTER TABLE runs ADD COLUMN {0} {1}".format(column, column_type))
+
+    def record(self, run, output, log_path):
+        import zlib
+        usage = run['usage'] or {}
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO runs (run_id, script, host, start, duration, exit_code, log_path, output, {0}) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, {1})".format(', '.join(column for column, _ in self.USAGE_COLUMNS),
+                                                              ', '.join('?' for _ in self.USAGE_COLUMNS)),
+                (run['id'], run['script'], run['host'], run['start'], run['duration'], run['exit_code'], log_path,
+                 zlib.compress(output.encode('utf-8'))) + tuple(usage.get(column) for column, _ in self.USAGE_COLUMNS))
+
+    def prune(self, retention_days):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM runs WHERE start < ?", (time.time() - retention_days * 24*60*60,))
+
+    def runs(self, script=None, failed=False, since=None, limit=20):
+        where, parameters = self._where(script, failed, since)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT run_id, script, host, start, duration, exit_code, log_path FROM runs {0} "
+                "ORDER BY start DESC LIMIT ?".format(where), parameters + [limit]).fetchall()
+        keys = ('run_id', 'script', 'host', 'start', 'duration', 'exit_code', 'log_path')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def output(self, run_id):
+        import zlib
+        with self._lock:
+            row = self._connection.execute("SELECT output FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def statistics(self, script=None, failed=False, since=None):
+        where, parameters = self._where(script, failed, since)
+        with self._lock:
+            count, failures, average, maximum, cpu_time, max_rss_kb = self._connection.execute(
+                "SELECT COUNT(*), SUM(exit_code != 0), AVG(duration), MAX(duration), "
+                "AVG(user_time + system_time), MAX(max_rss_kb) FROM runs {0}".format(where),
+                parameters).fetchone()
+            statistics = {'count': count, 'failures': failures or 0, 'average': average, 'max': maximum,
+                          'cpu_time': cpu_time, 'max_rss_kb': max_rss_kb}
+            for name, percentile in (('p50', 0.5), ('p95', 0.95)):
+                row = self._connection.execute(
+                    "SELECT duration FROM runs {0} ORDER BY duration LIMIT 1 OFFSET ?".format(where),
+                    parameters + [max(int(count * percentile + 0.5) - 1, 0)]).fetchone()
+                statistics[name] = row[0] if row is not None else None
+        return statistics
+
+    def close(self):
+        self._connection.close()
+
+    def _where(self, script, failed, since):
+        conditions = []
+        parameters = []
+        if script is not None:
+            conditions.append("script = ?")
+            parameters.append(script)
+        if failed:
+            conditions.append("exit_code != 0")
+        if since is not None:
+            conditions.append("start >= ?")
+            parameters.append(since)
+        return ("WHERE " + " AND ".join(conditions) if conditions else ""), parameters
+
+
+class MetricsExporter(object):
+    """Export the outcome of an execution to a Prometheus textfile and/or a StatsD server
+
+    Errors are ignored : the metrics must never delay nor break the execution.
+    """
+
+    METRICS = [
+        ('runs_total', 'counter', 'runs', 'Number of executions'),
+        ('failures_total', 'counter', 'failures', 'Number of failed executions'),
+        ('timeouts_total', 'counter', 'timeouts', 'Number of executions killed by the timeout'),
+        ('last_run_timestamp_seconds', 'gauge', 'last_run', 'Start time of the last execution'),
+        ('last_exit_code', 'gauge', 'last_exit_code', 'Exit code of the last execution'),
+        ('duration_seconds', 'histogram', 'duration', 'Duration of the executions'),
+        ('output_bytes', 'histogram', 'output_bytes', 'Size of the output of the executions'),
+        ('email_send_seconds', 'histogram', 'email_send', 'Time spent sending the emails'),
+        ('email_failures_total', 'counter', 'email_failures', 'Number of emails not sent nor queued'),
+    ]
+    BUCKETS = {
+        'duration': [0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600],
+        'output_bytes': [1024, 10*1024, 100*1024, 1024**2, 10*1024**2, 100*1024**2, 1024**3],
+        'email_send': [0.1, 0.5, 1, 5, 10, 30, 60],
+    }
+    LOCK_TIMEOUT = 1
+
+    def __init__(self, textfile=None, statsd=None, prefix='custom_cron'):
+        self.textfile = textfile
+        self.statsd = statsd
+        self.prefix = prefix
+
+    def emit(self, run):
+        if self.statsd is not None:
+            try:
+                self._send_to_statsd(run)
+            except (OSError, ValueError):
+                pass
+        if self.textfile is not None:
+            try:
+                self._update_textfile(run)
+            except (OSError, ValueError):
+                pass
+
+    def _send_to_statsd(self, run):
+        import socket
+        host, port = self.statsd.rsplit(':', 1)
+        name = "{0}.{1}".format(self.prefix, re.sub(r'[^A-Za-z0-9_-]+', '_', os.path.basename(run['script'] or 'none')))
+        lines = [
+            "{0}.runs:1|c".format(name),
+            "{0}.duration:{1}|ms".format(name, int(run['duration'] * 1000)),
+            "{0}.output_bytes:{1}|h".format(name, run['output_size']),
+        ]
+        if run['exit_code'] != 0:
+            lines.append("{0}.failures:1|c".format(name))
+        if run['timed_out']:
+            lines.append("{0}.timeouts:1|c".format(name))
+        if run['email_send_time'] is not None:
+            lines.append("{0}.email_send:{1}|ms".format(name, int(run['email_send_time'] * 1000)))
+        if run.get('email_error') is not None:
+            lines.append("{0}.email_failures:1|c".format(name))
+        statsd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            statsd.setblocking(False)
+            statsd.sendto('\n'.join(lines).encode('utf-8'), (host, int(port)))
+        finally:
+            statsd.close()
+
+    def _update_textfile(self, run):
+        import json
+        with open(self.textfile + '.lock', 'a') as lock:
+            deadline = time.monotonic() + self.LOCK_TIMEOUT
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        return
+                    time.sleep(0.01)
+            state = self._load_state()
+            script = state.setdefault(run['script'] or '', {})
+            for counter, increment in (('runs', 1), ('failures', int(run['exit_code'] != 0)), ('timeouts', int(run['timed_out'])),
+                                       ('email_failures', int(run.get('email_error') is not None))):
+                script[counter] = script.get(counter, 0) + increment
+            script['last_run'] = run['start']
+            script['last_exit_code'] = run['exit_code']
+            self._observe(script, 'duration', run['duration'])
+            self._observe(script, 'output_bytes', run['output_size'])
+            if run['email_send_time'] is not None:
+                self._observe(script, 'email_send', run['email_send_time'])
+            self._write_atomically(self.textfile + '.state', json.dumps(state))
+            self._write_atomically(self.textfile, self._render(state))
+
+    def _load_state(self):
+        import json
+        try:
+            with open(self.textfile + '.state', 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _observe(self, script, name, value):
+        buckets = self.BUCKETS[name]
+        histogram = script.setdefault(name, {'buckets': [0] * len(buckets), 'sum': 0, 'count': 0})
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                histogram['buckets'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def _render(self, state):
+        lines = []
+        for name, metric_type, key, help_text in self.METRICS:
+            metric = "{0}_{1}".format(self.prefix, name)
+            lines.append("# HELP {0} {1}".format(metric, help_text))
+            lines.append("# TYPE {0} {1}".format(metric, metric_type))
+            for script_name, script in sorted(state.items()):
+                if key not in script:
+                    continue
+                label = 'script="{0}"'.format(script_name.replace('\\', '\\\\').replace('"', '\\"'))
+                if metric_type != 'histogram':
+                    lines.append("{0}{{{1}}} {2}".format(metric, label, script[key]))
+                    continue
+                histogram = script[key]
+                for bound, count in zip(self.BUCKETS[key], histogram['buckets']):
+                    lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(metric, label, bound, count))
+                lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(metric, label, histogram['count']))
+                lines.append("{0}_sum{{{1}}} {2}".format(metric, label, histogram['sum']))
+                lines.append("{0}_count{{{1}}} {2}".format(metric, label, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def _write_atomically(self, path, content):
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+
+
+class HostSemaphore(object):
+    """Named slots shared by every process of the host, the waiters take a slot in their order of arrival
+
+    Each slot is a lock file held with flock while the script runs, so the kernel releases it when a process dies.
+    Every waiter holds a locked ticket in the queue directory of the slot and only the oldest live ticket
+    tries to take a slot, the tickets of dead waiters are not locked anymore and are removed.
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, directory, name, size):
+        self.directory = directory
+        self.name = name
+        self.size = size
+        self._slot = None
+
+    def acquire(self):
+        queue_path = os.path.join(self.directory, self.name + '.queue')
+        os.makedirs(queue_path, exist_ok=True)
+        ticket_name = "{0:020d}-{1}-{2}".format(time.time_ns(), os.getpid(), threading.get_ident())
+        ticket_path = os.path.join(queue_path, ticket_name)
+        # The ticket is locked before it is visible, otherwise it could be taken for the ticket of a dead waiter
+        ticket = open(os.path.join(queue_path, '.' + ticket_name), 'w')
+        try:
+            fcntl.flock(ticket, fcntl.LOCK_EX)
+            os.rename(ticket.name, ticket_path)
+            while True:
+                if self._is_first(queue_path, ticket_name):
+                    self._slot = self._take_slot()
+                    if self._slot is not None:
+                        return
+                time.sleep(self.POLL_INTERVAL)
+        finally:
+            for path in (ticket_path, ticket.name):
+                if os.path.exists(path):
+                    os.remove(path)
+            ticket.close()
+
+    def release(self):
+        if self._slot is not None:
+            self._slot.close()
+            self._slot = None
+
+    def _is_first(self, queue_path, ticket_name):
+        for name in sorted(os.listdir(queue_path)):
+            if name.startswith('.'):
+                continue
+            if name >= ticket_name:
+                return True
+            if self._is_alive(os.path.join(queue_path, name)):
+                return False
+        return True
+
+    def _is_alive(self, ticket_path):
+        try:
+            with open(ticket_path, 'r') as ticket:
+                try:
+                    fcntl.flock(ticket, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return True
+                os.remove(ticket_path)
+        except FileNotFoundError:
+            pass
+        return False
+
+    def _take_slot(self):
+        for index in range(self.size):
+            slot = open(os.path.join(self.directory, "{0}.{1}.lock".format(self.name, index)), 'a')
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except BlockingIOError:
+                slot.close()
+        return None
+
+
+class LeaseBackend(object):
+    """Store of the leases shared by the hosts, a new store is registered for the scheme of its URLs
+
+    A lease is named after a job and its scheduled instance. acquire returns a fencing token greater than the
+    token of every previous holder, or None while the lease is held or once the instance is done. The lease of a
+    holder not renewed within its duration is taken over with a greater token, renew then returns False.
+    """
+
+    BACKENDS = {}
+
+    @classmethod
+    def register(cls, scheme, backend_class):
+        cls.BACKENDS[scheme] = backend_class
+
+    @classmethod
+    def from_url(cls, url):
+        scheme, separator, location = url.partition('://')
+        if not separator:
+            scheme, location = 'file', url
+        if scheme not in cls.BACKENDS:
+            raise ValueError("Unknown lease backend : {0}".format(url))
+        return cls.BACKENDS[scheme](location)
+
+    def acquire(self, name, holder, duration):
+        raise NotImplementedError
+
+    def renew(self, name, token, holder, duration):
+        raise NotImplementedError
+
+    def complete(self, name, token, holder):
+        raise NotImplementedError
+
+
+class FileLeaseBackend(LeaseBackend):
+    """Leases in a directory of a shared file system, NFS included
+
+    Each holder of an instance is a file <job>/<instance>.<token>. It is written under a unique temporary name
+    then linked to its name, link being atomic on NFS where O_EXCL is not, and the link count of the temporary
+    file tells whether the link was made even when the reply of the server was lost. A renewal renames a new
+    version over the file of the holder. The expiry times are compared between hosts, their clocks must be in sync.
+    """
+
+    RETENTION = 24*60*60
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def acquire(self, name, holder, duration):
+        job_path, instance = self._paths(name)
+        os.makedirs(job_path, exist_ok=True)
+        now = time.time()
+        self._prune(job_path, now)
+        token, lease = self._current(job_path, instance)
+        if lease is not None and (lease['state'] == 'done' or lease['expires'] > now):
+            return None
+        token += 1
+        lease = {'holder': holder, 'token': token, 'expires': now + duration, 'state': 'running'}
+        if not self._link(job_path, "{0}.{1}".format(instance, token), lease):
+            return None
+        return token
+
+    def renew(self, name, token, holder, duration):
+        return self._update(name, {'holder': holder, 'token': token, 'expires': time.time() + duration, 'state': 'running'})
+
+    def complete(self, name, token, holder):
+        return self._update(name, {'holder': holder, 'token': token, 'expires': None, 'state': 'done'})
+
+    def _update(self, name, lease):
+        job_path, instance = self._paths(name)
+        if self._current(job_path, instance)[0] != lease['token']:
+            return False
+        os.rename(self._write(job_path, lease), os.path.join(job_path, "{0}.{1}".format(instance, lease['token'])))
+        return True
+
+    def _paths(self, name):
+        job, _, instance = name.rpartition('/')
+        return os.path.join(self.directory, job), instance
+
+    def _current(self, job_path, instance):
+        """Return the greatest token of the instance and its lease, 0 and None without holder"""
+        import json
+        prefix = instance + '.'
+        tokens = [int(name[len(prefix):]) for name in os.listdir(job_path)
+                  if name.startswith(prefix) and name[len(prefix):].isdigit()]
+        if not tokens:
+            return 0, None
+        token = max(tokens)
+        try:
+            with open(os.path.join(job_path, "{0}.{1}".format(instance, token)), 'r', encoding='utf-8') as f:
+                return token, json.load(f)
+        except FileNotFoundError:
+            return token, None
+
+    def _link(self, job_path, name, lease):
+        temporary_path = self._write(job_path, lease)
+        try:
+            try:
+                os.link(temporary_path, os.path.join(job_path, name))
+            except OSError:
+                # On NFS the link may be made even though an error is returned
+                pass
+            return os.stat(temporary_path).st_nlink == 2
+        finally:
+            os.remove(temporary_path)
+
+    def _write(self, job_path, lease):
+        import json
+        temporary_path = os.path.join(job_path, ".{0}-{1}-{2}-{3}.tmp".format(
+            os.uname()[1], os.getpid(), threading.get_ident(), os.urandom(4).hex()))
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump(lease, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return temporary_path
+
+    def _prune(self, job_path, now):
+        for name in os.listdir(job_path):
+            path = os.path.join(job_path, name)
+            try:
+                if now - os.stat(path).st_mtime > self.RETENTION:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+LeaseBackend.register('file', FileLeaseBackend)
+
+
+class Lease(object):
+    """Lease of a scheduled instance of a script, renewed in the background while the script runs"""
+
+    def __init__(self, backend, name, holder, duration):
+        self.backend = backend
+        self.name = name
+        self.holder = holder
+        self.duration = duration
+        self.token = None
+        self.lost = False
+        self._stop = threading.Event()
+        self._renewal = None
+
+    def acquire(self):
+        self.token = self.backend.acquire(self.name, self.holder, self.duration)
+        if self.token is None:
+            return False
+        self._renewal = threading.Thread(target=self._renew_periodically, daemon=True)
+        self._renewal.start()
+        return True
+
+    def release(self):
+        """Mark the instance as done, return False if the lease was taken over by an other host"""
+        if self._renewal is not None:
+            self._stop.set()
+            self._renewal.join()
+            self._renewal = None
+            if not self.lost:
+                try:
+                    self.lost = not self.backend.complete(self.name, self.token, self.holder)
+                except OSError:
+                    # Not marked as done, the instance can be taken over once the lease expires
+                    self.lost = True
+        return not self.lost
+
+    def abandon(self):
+        """Stop renewing the lease without marking the instance as done"""
+        if self._renewal is not None:
+            self._stop.set()
+            self._renewal.join()
+            self._renewal = None
+
+    def _renew_periodically(self):
+        while not self._stop.wait(self.duration / 3):
+            try:
+                if not self.backend.renew(self.name, self.token, self.holder, self.duration):
+                    self.lost = True
+                    return
+            except OSError:
+                # The shared storage may come back before the lease expires
+                pass
+
+
+class SharedResources(object):
+    """Log handles, SMTP connections and email sender kept alive between the executions of the daemon"""
+
+    SENDER_RETRY_INTERVAL = 30
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._logs = {}
+        self._history_stores = {}
+        self._smtp_pools = {}
+        self._outboxes = {}
+        self._log_shippers = {}
+        self._fork_servers = {}
+        self._sender = None
+        self._sender_wakeup = threading.Event()
+        self._closed = threading.Event()
+
+    def log_file(self, log_path, settings):
+        with self._lock:
+            if log_path not in self._logs:
+                self._logs[log_path] = LogFile(log_path, **settings)
+            return self._logs[log_path]
+
+    def history_store(self, history_path):
+        with self._lock:
+            if history_path not in self._history_stores:
+                self._history_stores[history_path] = HistoryStore(history_path)
+            return self._history_stores[history_path]
+
+    def log_shipper(self, target, spool_path, spool_max_size):
+        with self._lock:
+            if target not in self._log_shippers:
+                self._log_shippers[target] = LogShipper(target, spool_path, spool_max_size, batch_interval=1)
+            return self._log_shippers[target]
+
+    def fork_server(self, preload):
+        with self._lock:
+            if tuple(preload) not in self._fork_servers:
+                self._fork_servers[tuple(preload)] = ForkServer(preload)
+                self._fork_servers[tuple(preload)].start()
+            return self._fork_servers[tuple(preload)]
+
+    def smtp_pool(self, smtp_settings, connect):
+        key = tuple(sorted(smtp_settings.items(), key=lambda item: item[0]))
+        with self._lock:
+            if key not in self._smtp_pools:
+                self._smtp_pools[key] = SMTPConnectionPool(connect)
+            return self._smtp_pools[key]
+
+    def drain_in_background(self, outbox, smtp_pool):
+        with self._lock:
+            self._outboxes[outbox.path] = (outbox, smtp_pool)
+            if self._sender is None:
+                self._sender = threading.Thread(target=self._send_emails, daemon=True)
+                self._sender.start()
+        self._sender_wakeup.set()
+
+    def close(self):
+        self._closed.set()
+        self._sender_wakeup.set()
+        if self._sender is not None:
+            self._sender.join()
+        with self._lock:
+            for log in self._logs.values():
+                log.close()
+                log.wait_for_compressions()
+            for history in self._history_stores.values():
+                history.close()
+            for smtp_pool in self._smtp_pools.values():
+                smtp_pool.close()
+            for log_shipper in self._log_shippers.values():
+                log_shipper.close()
+            for fork_server in self._fork_servers.values():
+                fork_server.close()
+            self._logs = {}
+            self._log_shippers = {}
+            self._fork_servers = {}
+            self._history_stores = {}
+            self._smtp_pools = {}
+
+    def _send_emails(self):
+        while True:
+            self._sender_wakeup.wait(self.SENDER_RETRY_INTERVAL)
+            self._sender_wakeup.clear()
+            with self._lock:
+                outboxes = list(self._outboxes.values())
+            for outbox, smtp_pool in outboxes:
+                outbox.drain(smtp_pool)
+            if self._closed.is_set():
+                return
+
+
+class CronExpression(object):
+    """Standard five fields cron expression (minute hour day-of-month month day-of-week)"""
+
+    MACROS = {
+        '@yearly': '0 0 1 1 *',
+        '@annually': '0 0 1 1 *',
+        '@monthly': '0 0 1 * *',
+        '@weekly': '0 0 * * 0',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@hourly': '0 * * * *',
+    }
+    FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+    MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+    WEEKDAYS = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+    # Names accepted by each field, case insensitive
+    NAMES = [{}, {}, {}, dict((name, index + 1) for index, name in enumerate(MONTHS)),
+             dict((name, index) for index, name in enumerate(WEEKDAYS))]
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = self.MACROS.get(expression, expression).split()
+        if len(fields) != 5:
+            raise ValueError("Invalid cron expression : {0}".format(expression))
+        try:
+            values = [self._parse_field(field, low, high, names)
+                      for field, (low, high), names in zip(fields, self.FIELDS, self.NAMES)]
+        except ValueError as e:
+            raise ValueError("Invalid cron expression : {0} ({1})".format(expression, e))
+        self.minutes, self.hours, self.days, self.months, self.weekdays = values
+        # Sunday can be written 0 or 7
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def next_fire(self, after):
+        """Return the first matching minute strictly after the given datetime"""
+        import datetime
+        moment = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = self._first_day_of_next_month(moment)
+            elif not self._is_day_matching(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError("Cron expression never matches : {0}".format(self.expression))
+
+    def _is_day_matching(self, moment):
+        day_matching = moment.day in self.days
+        weekday_matching = (moment.weekday() + 1) % 7 in self.weekdays
+        if self._any_day:
+            return weekday_matching
+        if self._any_weekday:
+            return day_matching
+        # Like cron, when both fields are restricted any of them can match
+        return day_matching or weekday_matching
+
+    def _first_day_of_next_month(self, moment):
+        if moment.month == 12:
+            return moment.replace(year=moment.year + 1, month=1, day=1, hour=0, minute=0)
+        return moment.replace(month=moment.month + 1, day=1, hour=0, minute=0)
+
+    def _parse_field(self, field, low, high, names):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = self._parse_value(field, step, {})
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [self._parse_value(field, value, names) for value in part.split('-', 1)]
+            else:
+                start = self._parse_value(field, part, names)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError("Invalid cron field : {0}".format(field))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _parse_value(self, field, value, names):
+        if value.lower() in names:
+            return names[value.lower()]
+        if not value.isdigit():
+            raise ValueError("Invalid cron field : {0}".format(field))
+        return int(value)
+
+
+class ScheduledJob(object):
+
+    def __init__(self, expression, custom_cron):
+        self.expression = expression
+        self.custom_cron = custom_cron
+
+
+class Scheduler(object):
+    """Long running process executing the jobs of a crontab-like table"""
+
+    def __init__(self, args):
+        self.args = args
+        self.resources = SharedResources()
+        self.configuration = None
+        if args.configuration_path is not None:
+            self.configuration = ConfigurationLoader(args.configuration_path, args.configuration_cache)
+        self.base_custom_cron, self.jobs = self._load()
+        self._queue = []
+        self._threads = []
+        self._stop = threading.Event()
+        self._reload = threading.Event()
+        self._wakeup = threading.Event()
+        self._sequence = 0
+
+    def run(self):
+        import datetime
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.request_reload())
+        self._start_fork_server()
+        self.schedule(datetime.datetime.now())
+        try:
+            while not self._stop.is_set():
+                if self._reload.is_set():
+                    self._reload.clear()
+                    self.reload(datetime.datetime.now())
+                next_fire = self._queue[0][0] if self._queue else None
+                wait_time = None if next_fire is None else (next_fire - datetime.datetime.now()).total_seconds()
+                if wait_time is not None and wait_time <= 0 and self._is_saturated():
+                    # The due jobs wait for the end of an execution
+                    wait_time = None
+                if wait_time is None or wait_time > 0:
+                    self._wakeup.wait(wait_time)
+                    self._wakeup.clear()
+                    continue
+                self.run_pending(datetime.datetime.now())
+        finally:
+            self.join()
+            self.resources.close()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def request_reload(self):
+        self._reload.set()
+        self._wakeup.set()
+
+    def reload(self, now):
+        """Read the configuration and the job table again, only the changed configuration files are parsed"""
+        try:
+            self.base_custom_cron, self.jobs = self._load()
+        except (OSError, ValueError) as e:
+            # Keep the current jobs rather than stopping on a broken configuration
+            sys.stderr.write("ERROR : Configuration not reloaded : {0}\n".format(e))
+            return
+        self._start_fork_server()
+        self.schedule(now)
+
+    def _start_fork_server(self):
+        # Forked before the executions start their threads, or before the new jobs run on reload
+        if any(job.custom_cron._is_fork_server_needed() for job in self.jobs):
+            self.resources.fork_server(self.base_custom_cron.python_preload)
+
+    def _load(self):
+        base_custom_cron = CustomCron(self.args, self.resources, self.configuration)
+        return base_custom_cron, self._load_table(base_custom_cron, self.args.daemon_path)
+
+    def schedule(self, now):
+        self._queue = []
+        for job in self.jobs:
+            self._push(job, job.expression.next_fire(now))
+
+    def run_pending(self, now):
+        """Start the due jobs, at most max_parallel executions at once, the others stay due"""
+        import heapq
+        while self._queue and self._queue[0][0] <= now and not self._is_saturated():
+            fire_time, _, job = heapq.heappop(self._queue)
+            execution = threading.Thread(target=self._execute, args=(job, fire_time.timestamp()))
+            execution.start()
+            self._threads.append(execution)
+            self._push(job, job.expression.next_fire(max(fire_time, now)))
+
+    def _execute(self, job, scheduled_time):
+        try:
+            job.custom_cron.execute_script(scheduled_time)
+        finally:
+            # A due job may be waiting for this execution to end
+            self._wakeup.set()
+
+    def _is_saturated(self):
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        return len(self._threads) >= self.base_custom_cron.max_parallel
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _push(self, job, fire_time):
+        import heapq
+        self._sequence += 1
+        heapq.heappush(self._queue, (fire_time, self._sequence, job))
+
+    def _load_table(self, base_custom_cron, table_path):
+        import shlex
+        jobs = []
+        with open(table_path, 'r', encoding='utf-8') as table:
+            for line in table:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('@'):
+                    expression, command = line.split(None, 1)
+                else:
+                    fields = line.split(None, 5)
+                    if len(fields) != 6:
+                        raise ValueError("Invalid job definition : {0}".format(line))
+                    expression, command = ' '.join(fields[:5]), fields[5]
+                command = shlex.split(command)
+                custom_cron = base_custom_cron.for_script(command[0], command[1:])
+                jobs.append(ScheduledJob(CronExpression(expression), custom_cron))
+        return jobs
+
+
+class HistoryCommand(object):
+    """Query the history of the past executions"""
+
+    # The percentiles sort the durations of the window, not of the whole history
+    STATISTICS_DEFAULT_SINCE = '30d'
+
+    def __init__(self, args):
+        self.args = args
+        self.history_path = args.history_path
+        if self.history_path is None and args.configuration_path is not None:
+            config = ConfigurationLoader(args.configuration_path, args.configuration_cache).load()
+            if "history" in config and "path" in config["history"]:
+                self.history_path = config["history"]["path"]
+        if self.history_path is None:
+            raise ValueError("No history database given")
+
+    def execute(self):
+        history = HistoryStore(self.history_path)
+        try:
+            if self.args.run_id is not None:
+                script_output = history.output(self.args.run_id)
+                print(script_output if script_output is not None else "ERROR : Run {0} not found".format(self.args.run_id))
+                return
+            since = self._parse_since(self.args.since)
+            if self.args.statistics:
+                if since is None:
+                    since = self._parse_since(self.STATISTICS_DEFAULT_SINCE)
+                print(self._format_statistics(history.statistics(self.args.script, self.args.failed, since)))
+                return
+            for run in history.runs(self.args.script, self.args.failed, since, self.args.limit):
+                print(self._format_run(run))
+        finally:
+            history.close()
+
+    def _parse_since(self, since):
+        import datetime
+        if since is None:
+            return None
+        units = {'m': 60, 'h': 60*60, 'd': 24*60*60, 'w': 7*24*60*60}
+        if since[-1:] in units and since[:-1].isdigit():
+            return time.time() - int(since[:-1]) * units[since[-1]]
+        return datetime.datetime.fromisoformat(since).timestamp()
+
+    def _format_run(self, run):
+        import datetime
+        return "{0}  {1}  exit code {2:<3}  {3:>9.1f}s  {4}  {5}  {6}".format(
+            datetime.datetime.fromtimestamp(run['start']).strftime('%Y-%m-%d %H:%M:%S'),
+            "OK  " if run['exit_code'] == 0 else "FAIL", run['exit_code'], run['duration'],
+            run['host'], run['script'], run['run_id'])
+
+    def _format_statistics(self, statistics):
+        lines = [
+            "Executions : {0}".format(statistics['count']),
+            "Failures : {0}".format(statistics['failures']),
+        ]
+        if statistics['count'] > 0:
+            lines.append("Duration : average {0:.1f}s, p50 {1:.1f}s, p95 {2:.1f}s, max {3:.1f}s".format(
+                statistics['average'], statistics['p50'], statistics['p95'], statistics['max']))
+        if statistics['cpu_time'] is not None:
+            lines.append("Resources : average CPU time {0:.2f}s, max RSS {1} KB".format(
+                statistics['cpu_time'], statistics['max_rss_kb']))
+        return '\n'.join(lines)
+
+
 class ArgumentsParser(object):
 
     def __init__(self):
@@ -147,12 +3182,54 @@ class ArgumentsParser(object):
                                  action='store',
                                  default=None,
                                  dest='configuration_path',
-                                 help='path to the configuration file')
+                                 help='path to the configuration file or conf.d directory')
+        self.parser.add_argument('--configuration_cache',
+                                 action='store',
+                                 default=None,
+                                 dest='configuration_cache',
+                                 help='path of the cache of the parsed configuration files')
         self.parser.add_argument('--logfile',
                                  action='store',
                                  default=None,
                                  dest='log_path',
                                  help='path where to log the output')
+        self.parser.add_argument('--log_format',
+                                 action='store',
+                                 choices=LogSink.FORMATS,
+                                 default=None,
+                                 dest='log_format',
+                                 help='format of the log : raw output, framed executions or JSON records (default: raw)')
+        self.parser.add_argument('--log_max_size',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='log_max_size',
+                                 help='rotate the log file once it reaches this size in bytes')
+        self.parser.add_argument('--log_ship',
+                                 action='store',
+                                 default=None,
+                                 dest='log_ship',
+                                 help='send the output and outcome of every execution to syslog, syslog:///path/to/socket, udp://HOST:PORT or tcp://HOST:PORT')
+        self.parser.add_argument('--log_ship_spool',
+                                 action='store',
+                                 default=None,
+                                 dest='log_ship_spool',
+                                 help='directory keeping the records which could not be sent, to send them later')
+        self.parser.add_argument('--history',
+                                 action='store',
+                                 default=None,
+                                 dest='history_path',
+                                 help='path to the SQLite database recording the executions')
+        self.parser.add_argument('--metrics_textfile',
+                                 action='store',
+                                 default=None,
+                                 dest='metrics_textfile',
+                                 help='path of the Prometheus textfile where to export the metrics')
+        self.parser.add_argument('--statsd',
+                                 action='store',
+                                 default=None,
+                                 dest='metrics_statsd',
+                                 help='HOST:PORT of the StatsD server where to send the metrics')
         self.parser.add_argument('--smtp_host',
                                  action='store',
                                  default=None,
@@ -183,24 +3260,263 @@ class ArgumentsParser(object):
                                  default=False,
                                  dest='email_only_on_fail',
                                  help='send an email only if the script to execute failed')
+        self.parser.add_argument('--email_outbox',
+                                 action='store',
+                                 default=None,
+                                 dest='email_outbox',
+                                 help='queue the emails in this directory and deliver them in background')
+        self.parser.add_argument('--email_digest',
+                                 action='store',
+                                 default=None,
+                                 dest='email_digest',
+                                 help='gather the results in this directory and send them in a single email per recipient')
+        self.parser.add_argument('--email_digest_interval',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='email_digest_interval',
+                                 help='time in sec between two digest emails (default: 3600)')
+        self.parser.add_argument('--email_digest_failures_immediately',
+                                 action='store_true',
+                                 default=False,
+                                 dest='email_digest_failures_immediately',
+                                 help='send the failures right away instead of adding them to the digest')
+        self.parser.add_argument('--email_digest_flush',
+                                 action='store_true',
+                                 default=False,
+                                 dest='email_digest_flush',
+                                 help='only send the digest emails whose interval is over')
+        self.parser.add_argument('--email_max_body_size',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='email_max_body_size',
+                                 help='maximum size in characters of the email body, the middle of the output is elided beyond')
+        self.parser.add_argument('--email_body_lines',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='email_body_lines',
+                                 help='only keep this number of lines at the beginning and at the end of the output')
+        self.parser.add_argument('--email_attach_above',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='email_attach_above',
+                                 help='attach the full output compressed when it is longer than this number of characters')
+        self.parser.add_argument('--email_resource_usage',
+                                 action='store_true',
+                                 default=False,
+                                 dest='email_resource_usage',
+                                 help='add the duration, CPU time and memory used by the script to the email')
+        self.parser.add_argument('--email_dedup',
+                                 action='store',
+                                 default=None,
+                                 dest='email_dedup',
+                                 help='path of the cache of the failures, a repeated failure is only sent again as a reminder')
+        self.parser.add_argument('--email_reminder_interval',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='email_reminder_interval',
+                                 help='time in seconds between two emails for the same failure (default: 86400)')
+        self.parser.add_argument('--stats_file',
+                                 action='store',
+                                 default=None,
+                                 dest='stats_path',
+                                 help='append a JSON record with the resource usage of every execution to this file')
         self.parser.add_argument('--script_to_execute_timeout',
                                  action='store',
                                  default=None,
                                  dest='script_to_execute_timeout',
                                  help='timeout in sec for the script to execute')
+        self.parser.add_argument('--script_to_execute_kill_grace',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='script_to_execute_kill_grace',
+                                 help='time in sec between the SIGTERM and the SIGKILL sent to the processes of the script on timeout (default: 5)')
+        self.parser.add_argument('--nice',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='nice',
+                                 help='scheduling niceness of the script, from -20 to 19')
+        self.parser.add_argument('--ionice',
+                                 action='store',
+                                 default=None,
+                                 dest='ionice',
+                                 help='CLASS[:LEVEL] I/O scheduling class (realtime, best-effort or idle) and level from 0 to 7 of the script')
+        self.parser.add_argument('--cpu_affinity',
+                                 action='store',
+                                 default=None,
+                                 dest='cpu_affinity',
+                                 help='CPUs the script can run on, for instance 0-3,6')
+        self.parser.add_argument('--limit_cpu',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='limit_cpu',
+                                 help='maximum CPU time in sec of the script')
+        self.parser.add_argument('--limit_memory',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='limit_memory',
+                                 help='maximum address space in bytes of the script')
+        self.parser.add_argument('--limit_files',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='limit_files',
+                                 help='maximum number of files opened at once by the script')
+        self.parser.add_argument('--limit_file_size',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='limit_file_size',
+                                 help='maximum size in bytes of a file written by the script')
+        self.parser.add_argument('--python_preload',
+                                 action='store',
+                                 default=None,
+                                 dest='python_preload',
+                                 help='comma separated modules imported once before the python:MODULE:FUNCTION entry points are forked')
+        self.parser.add_argument('--max_parallel',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='max_parallel',
+                                 help='maximum number of jobs executed at once (default: number of CPUs)')
+        self.parser.add_argument('--max_load',
+                                 action='store',
+                                 type=float,
+                                 default=None,
+                                 dest='max_load',
+                                 help='do not start a new job while the load average is above this value')
+        self.parser.add_argument('--splay',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='splay',
+                                 help='delay the start by up to this number of seconds, always the same delay for a script on a host')
+        self.parser.add_argument('--slot',
+                                 action='store',
+                                 default=None,
+                                 dest='slot',
+                                 help='NAME[:SIZE] of the host-wide slot to hold while the script runs, at most SIZE scripts run at once (default: 1)')
+        self.parser.add_argument('--slots_directory',
+                                 action='store',
+                                 default=None,
+                                 dest='slots_directory',
+                                 help='directory of the lock files of the slots (default: {0})'.format(SLOTS_DIRECTORY))
+        self.parser.add_argument('--lease',
+                                 action='store',
+                                 default=None,
+                                 dest='lease',
+                                 help='URL of the leases shared by the hosts (file:///DIRECTORY), only one host executes each scheduled instance')
+        self.parser.add_argument('--lease_duration',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='lease_duration',
+                                 help='seconds before a lease not renewed can be taken over by an other host (default: 60)')
+        self.parser.add_argument('--lease_window',
+                                 action='store',
+                                 type=int,
+                                 default=None,
+                                 dest='lease_window',
+                                 help='the executions started within this number of seconds are the same instance (default: 60)')
+        self.parser.add_argument('--daemon',
+                                 action='store',
+                                 default=None,
+                                 dest='daemon_path',
+                                 help='run as a daemon executing the jobs of the given crontab-like table')
         self.parser.add_argument('script_to_execute',
-                                 help='the script to execute')
+                                 nargs='?',
+                                 default=None,
+                                 help='the script to execute, or python:MODULE:FUNCTION to call a Python entry point')
         self.parser.add_argument('--script_args',
                                  nargs='+',
                                  dest='script_to_execute_args',
                                  default=[],
                                  help='arguments for the script to execute ')
+        self.parser.set_defaults(command='execute')
+        self.history_parser = argparse.ArgumentParser(
+            prog='custom_cron.py history',
+            description='Query the history of the past executions')
+        self.history_parser.add_argument('--configuration',
+                                         action='store',
+                                         default=None,
+                                         dest='configuration_path',
+                                         help='path to the configuration file giving the history database')
+        self.history_parser.add_argument('--configuration_cache',
+                                         action='store',
+                                         default=None,
+                                         dest='configuration_cache',
+                                         help='path of the cache of the parsed configuration files')
+        self.history_parser.add_argument('--history',
+                                         action='store',
+                                         default=None,
+                                         dest='history_path',
+                                         help='path to the SQLite database recording the executions')
+        self.history_parser.add_argument('--script',
+                                         action='store',
+                                         default=None,
+                                         dest='script',
+                                         help='only the executions of this script')
+        self.history_parser.add_argument('--failed',
+                                         action='store_true',
+                                         default=False,
+                                         dest='failed',
+                                         help='only the failed executions')
+        self.history_parser.add_argument('--since',
+                                         action='store',
+                                         default=None,
+                                         dest='since',
+                                         help='only the executions since this date (ISO format) or duration (30m, 12h, 7d, 4w)')
+        self.history_parser.add_argument('--limit',
+                                         action='store',
+                                         type=int,
+                                         default=20,
+                                         dest='limit',
+                                         help='maximum number of executions listed (default: 20)')
+        self.history_parser.add_argument('--stats',
+                                         action='store_true',
+                                         default=False,
+                                         dest='statistics',
+                                         help='print the number of executions, failures and the duration percentiles, '
+                                              'of the last 30 days without --since')
+        self.history_parser.add_argument('--output',
+                                         action='store',
+                                         default=None,
+                                         dest='run_id',
+                                         help='print the output recorded for this run id')
+        self.history_parser.set_defaults(command='history')
 
     def parse(self, arguments):
+        if len(arguments) > 0 and arguments[0] == 'history':
+            return self.history_parser.parse_args(args=arguments[1:])
+        if arguments == ['drain_outbox']:
+            # Internal command of the detached email sender, its settings are read from stdin
+            return argparse.Namespace(command='drain_outbox')
         return self.parser.parse_args(args=arguments)
 
 
 if __name__ == '__main__':
     args = ArgumentsParser().parse(sys.argv[1:])
-    custom_cron = CustomCron(args)
-    custom_cron.execute_script()
+    if args.command == 'history':
+        HistoryCommand(args).execute()
+    elif args.command == 'drain_outbox':
+        import json
+        sender = json.load(sys.stdin)
+        custom_cron = CustomCron(ArgumentsParser().parse([]))
+        custom_cron.email_outbox = sender['outbox']
+        custom_cron.smtp_connection = sender['smtp_connection']
+        custom_cron.drain_outbox()
+    elif args.daemon_path is not None:
+        Scheduler(args).run()
+    elif args.email_digest_flush:
+        CustomCron(args).flush_digest()
+    else:
+        custom_cron = CustomCron(args)
+        custom_cron.execute_script()
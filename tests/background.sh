@@ -0,0 +1,5 @@
+#! /bin/sh
+
+echo "Start"
+sleep 4 &
+echo "Done"
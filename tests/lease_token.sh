@@ -0,0 +1,3 @@
+#! /bin/sh
+
+echo "Lease token $CUSTOM_CRON_LEASE_TOKEN"
@@ -0,0 +1,69 @@
+#! /usr/bin/python3
+# -*- encoding: utf8 -*-
+
+import json
+import socketserver
+import threading
+
+
+class LocalLogCollector(threading.Thread):
+    """Minimal TCP or UDP log collector recording the JSON records received, one per line"""
+
+    def __init__(self, port, protocol='tcp'):
+        threading.Thread.__init__(self, daemon=True)
+        self.ready = False
+        self.server = None
+        self._port = port
+        self._protocol = protocol
+
+    def run(self):
+        if self._protocol == 'tcp':
+            self.server = RecordingTCPServer(('127.0.0.1', self._port), TCPRecordsHandler)
+        else:
+            self.server = RecordingUDPServer(('127.0.0.1', self._port), UDPRecordsHandler)
+        self.ready = True
+        self.server.serve_forever(poll_interval=0.1)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RecordingServer(object):
+
+    def record(self, lines):
+        with self.lock:
+            self.records.extend(json.loads(line) for line in lines if line.strip())
+
+
+class RecordingTCPServer(RecordingServer, socketserver.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, local_addr, handler):
+        socketserver.ThreadingTCPServer.__init__(self, local_addr, handler)
+        self.records = []
+        self.lock = threading.Lock()
+
+
+class RecordingUDPServer(RecordingServer, socketserver.UDPServer):
+
+    allow_reuse_address = True
+
+    def __init__(self, local_addr, handler):
+        socketserver.UDPServer.__init__(self, local_addr, handler)
+        self.records = []
+        self.lock = threading.Lock()
+
+
+class TCPRecordsHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.record(line.decode('utf-8') for line in self.rfile)
+
+
+class UDPRecordsHandler(socketserver.DatagramRequestHandler):
+
+    def handle(self):
+        self.server.record(self.rfile.read().decode('utf-8').split('\n'))
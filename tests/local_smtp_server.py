@@ -0,0 +1,107 @@
+#! /usr/bin/python3
+# -*- encoding: utf8 -*-
+
+import socketserver
+import threading
+
+
+class LocalSMTPServer(threading.Thread):
+    """Minimal SMTP server recording the received emails, replacing the smtpd module removed from Python 3.12"""
+
+    def __init__(self, port):
+        threading.Thread.__init__(self, daemon=True)
+        self.ready = False
+        self.server = None
+        self._port = port
+
+    def run(self):
+        self.server = RecordingSMTPServer(('127.0.0.1', self._port))
+        self.ready = True
+        self.server.serve_forever(poll_interval=0.1)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RecordingSMTPServer(socketserver.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, local_addr):
+        socketserver.ThreadingTCPServer.__init__(self, local_addr, SMTPHandler)
+        self.peer = None
+        self.mailfrom = None
+        self.rcpttos = None
+        self.data = None
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        with self._lock:
+            self.peer = peer
+            self.mailfrom = mailfrom
+            self.rcpttos = rcpttos
+            self.data = data
+            self.messages.append((mailfrom, rcpttos, data))
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self._reply('220 localhost custom_cron test SMTP server')
+        mailfrom, rcpttos = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, argument = line.decode('utf-8').rstrip('\r\n').partition(' ')
+            command = command.upper()
+            if command == 'EHLO':
+                self._reply('250-localhost', '250 8BITMIME')
+            elif command == 'HELO':
+                self._reply('250 localhost')
+            elif command == 'MAIL':
+                mailfrom, rcpttos = self._address(argument), []
+                self._reply('250 OK')
+            elif command == 'RCPT':
+                address = self._address(argument)
+                # Addresses to test the permanent and temporary refusals
+                if address.startswith('refused@'):
+                    self._reply('550 Mailbox unavailable')
+                elif address.startswith('busy@'):
+                    self._reply('451 Try again later')
+                else:
+                    rcpttos.append(address)
+                    self._reply('250 OK')
+            elif command == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                self.server.process_message(self.client_address, mailfrom, rcpttos, self._read_data())
+                mailfrom, rcpttos = None, []
+                self._reply('250 OK')
+            elif command == 'RSET':
+                mailfrom, rcpttos = None, []
+                self._reply('250 OK')
+            elif command == 'NOOP':
+                self._reply('250 OK')
+            elif command == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+    def _read_data(self):
+        # Same content as smtpd with decode_data : lines joined by \n, without the final line break
+        lines = []
+        while True:
+            line = self.rfile.readline().decode('utf-8').rstrip('\r\n')
+            if line == '.':
+                return '\n'.join(lines)
+            lines.append(line[1:] if line.startswith('.') else line)
+
+    def _address(self, argument):
+        return argument.split(':', 1)[1].split()[0].strip('<>')
+
+    def _reply(self, *lines):
+        self.wfile.write(''.join(line + '\r\n' for line in lines).encode('utf-8'))
@@ -0,0 +1,10 @@
+#! /bin/sh
+
+if [ "$1" = "ignore" ]; then
+    trap '' TERM
+else
+    trap 'echo "Stopping"; exit 1' TERM
+fi
+sleep 30 &
+echo "Child $!"
+wait
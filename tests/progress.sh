@@ -0,0 +1,5 @@
+#! /bin/sh
+
+echo "Step 1"
+sleep 2
+echo "Step 2"
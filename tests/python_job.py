@@ -0,0 +1,30 @@
+#! /usr/bin/python3
+# -*- encoding: utf8 -*-
+
+import os
+import sys
+import time
+
+# Pid of the process which imported the module, the fork server when it is preloaded
+IMPORTED_BY = os.getpid()
+
+
+def hello():
+    print("Hello {0}".format(' '.join(sys.argv[1:])))
+
+
+def preloaded():
+    print("Preloaded" if IMPORTED_BY != os.getpid() else "Imported by the worker")
+
+
+def fail():
+    raise ValueError("Bad value")
+
+
+def exit_status():
+    sys.exit(int(sys.argv[1]))
+
+
+def sleep():
+    print("Sleeping", flush=True)
+    time.sleep(10)
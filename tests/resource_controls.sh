@@ -0,0 +1,5 @@
+#! /bin/sh
+
+echo "nice $(nice)"
+echo "files $(ulimit -n)"
+grep Cpus_allowed_list /proc/self/status
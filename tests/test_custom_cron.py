@@ -1,13 +1,35 @@
 #! /usr/bin/python3
 # -*- encoding: utf8 -*-
 
-import asyncore
+import base64
+import contextlib
+import datetime
+import email
+import glob
+import gzip
+import io
+import json
 import os
-import smtpd
+import shutil
+import socket
+import subprocess
+import sys
+import time
 import unittest
+import unittest.mock
 import threading
+import zlib
+from smtplib import SMTP
 
-from src.custom_cron import CustomCron
+from tests.local_log_collector import LocalLogCollector
+from tests.local_smtp_server import LocalSMTPServer
+from src.custom_cron import AlertCache, ArgumentsParser, ConfigurationLoader, CustomCron, CronExpression, EmailBodySink, FileLeaseBackend, HistoryCommand, HistoryStore, HostSemaphore, LogFile, Outbox, ResourceControls, Scheduler, SharedResources, SMTPConnectionPool
+
+
+# Cumulative time of `python -X importtime -c "import custom_cron"`, in seconds, loaded from the bytecode
+STARTUP_IMPORT_TIME_TARGET = 0.1
+LAZY_MODULES = ('configparser', 'email.mime.text', 'smtplib', 'sqlite3', 'tempfile', 'json', 'gzip', 'socket',
+                'concurrent.futures', 'datetime', 'uuid')
 
 
 class TestCustomCron(unittest.TestCase):
@@ -21,8 +43,28 @@ class TestCustomCron(unittest.TestCase):
         unittest.TestCase.tearDown(self)
         if self.server_thread is not None:
             self.server_thread.stop()
-        if os.path.isfile("/tmp/log"):
-            os.remove("/tmp/log")
+        for log_path in glob.glob("/tmp/log") + glob.glob("/tmp/log.*") + glob.glob("/tmp/log2.*"):
+            os.remove(log_path)
+        if os.path.isdir("/tmp/outbox"):
+            shutil.rmtree("/tmp/outbox")
+        if os.path.isfile("/tmp/stats"):
+            os.remove("/tmp/stats")
+        if os.path.isdir("/tmp/conf.d"):
+            shutil.rmtree("/tmp/conf.d")
+        if os.path.isdir("/tmp/slots"):
+            shutil.rmtree("/tmp/slots")
+        if os.path.isdir("/tmp/shipping"):
+            shutil.rmtree("/tmp/shipping")
+        if os.path.isdir("/tmp/leases"):
+            shutil.rmtree("/tmp/leases")
+        for metrics_path in glob.glob("/tmp/metrics.prom*"):
+            os.remove(metrics_path)
+        if os.path.isdir("/tmp/digest"):
+            shutil.rmtree("/tmp/digest")
+        for alerts_path in glob.glob("/tmp/alerts.json*") + glob.glob("/tmp/flaky*"):
+            os.remove(alerts_path)
+        for history_path in glob.glob("/tmp/history.db*"):
+            os.remove(history_path)
 
     def test_simple_hello_script(self):
         self.args.script_to_execute = './hello.sh'
@@ -75,6 +117,205 @@ class TestCustomCron(unittest.TestCase):
             line = f.read()
         self.assertEqual(line, "So far so good !\ncp: missing file operand\nTry 'cp --help' for more information.\n", "Content do not match")
 
+    def test_log_framed(self):
+        self.args.script_to_execute = './error.sh'
+        self.args.log_path = '/tmp/log'
+        self.args.log_format = 'framed'
+        CustomCron(self.args).execute_script()
+        CustomCron(self.args).execute_script()
+        with open("/tmp/log", 'r') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 10)
+        self.assertRegex(lines[0], r'^=== (\w+) start \d{4}-\d\d-\d\dT\d\d:\d\d:\d\d host ' + os.uname()[1] + ' script ./error.sh ===$')
+        self.assertEqual(lines[1:4], ["So far so good !", "cp: missing file operand", "Try 'cp --help' for more information."])
+        self.assertRegex(lines[4], r'^=== ' + lines[0].split()[1] + r' end exit code 1 duration \d+\.\d{3}s user \d+\.\d{3}s system \d+\.\d{3}s max rss \d+ KB ===$')
+        self.assertNotEqual(lines[0].split()[1], lines[5].split()[1], 'Same run id')
+
+    def test_log_json(self):
+        self.args.script_to_execute = './hello.sh'
+        self.args.log_path = '/tmp/log'
+        self.args.log_format = 'json'
+        CustomCron(self.args).execute_script()
+        os.remove("./world")
+        with open("/tmp/log", 'r') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record['event'] for record in records], ['start', 'output', 'end'])
+        self.assertEqual(len(set(record['run'] for record in records)), 1)
+        self.assertEqual(records[0]['script'], './hello.sh')
+        self.assertEqual(records[1]['data'], "So far so good !\n")
+        self.assertEqual(records[2]['exit_code'], 0)
+
+    def test_log_rotation(self):
+        log_file = LogFile('/tmp/log', max_size=10, backups=2)
+        for index in range(4):
+            log_file.append("Execution {0}\n".format(index))
+        log_file.close()
+        log_file.wait_for_compressions()
+        with open("/tmp/log", 'r') as f:
+            self.assertEqual(f.read(), "Execution 3\n")
+        backups = sorted(glob.glob("/tmp/log.[0-9]*"))
+        self.assertEqual(len(backups), 2)
+        with gzip.open(backups[-1], 'rt') as f:
+            self.assertEqual(f.read(), "Execution 2\n")
+
+    def test_log_shipped_to_collector(self):
+        self.server_thread = self._instanciate_local_log_collector(1514, 'tcp')
+        self.args.log_ship = 'tcp://127.0.0.1:1514'
+        self.args.script_to_execute = './hello.sh'
+        CustomCron(self.args).execute_script()
+        os.remove("./world")
+        time.sleep(0.2)
+        records = self.server_thread.server.records
+        self.assertEqual(len(records), 1)
+        self.assertEqual((records[0]['script'], records[0]['exit_code'], records[0]['output']), ('./hello.sh', 0, "So far so good !\n"))
+        self.assertEqual(records[0]['host'], os.uname()[1])
+
+    def test_log_shipped_over_udp_compressed(self):
+        self.server_thread = self._instanciate_local_log_collector(1515, 'udp')
+        self.args.log_ship = 'udp://127.0.0.1:1515'
+        self.args.script_to_execute = '/bin/seq'
+        self.args.script_to_execute_args = ['1000']
+        CustomCron(self.args).execute_script()
+        time.sleep(0.2)
+        record = self.server_thread.server.records[0]
+        self.assertEqual(record['output_encoding'], 'zlib+base64')
+        output = zlib.decompress(base64.b64decode(record['output'])).decode('utf-8')
+        self.assertEqual(output, ''.join("{0}\n".format(number) for number in range(1, 1001)))
+
+    def test_log_spilled_while_collector_down(self):
+        self.args.log_ship = 'tcp://127.0.0.1:1516'
+        self.args.log_ship_spool = '/tmp/shipping'
+        self.args.script_to_execute = './error.sh'
+        CustomCron(self.args).execute_script()
+        self.assertEqual(len([name for name in os.listdir('/tmp/shipping') if name.endswith('.jsonl')]), 1, 'Record not spilled')
+        self.server_thread = self._instanciate_local_log_collector(1516, 'tcp')
+        self.args.script_to_execute = './hello.sh'
+        CustomCron(self.args).execute_script()
+        os.remove("./world")
+        time.sleep(0.2)
+        self.assertEqual([record['script'] for record in self.server_thread.server.records], ['./error.sh', './hello.sh'])
+        self.assertEqual([name for name in os.listdir('/tmp/shipping') if name.endswith('.jsonl')], [])
+
+    def test_history_recorded(self):
+        self.args.history_path = '/tmp/history.db'
+        self.args.script_to_execute = './hello.sh'
+        CustomCron(self.args).execute_script()
+        os.remove("./world")
+        self.args.script_to_execute = './error.sh'
+        CustomCron(self.args).execute_script()
+        CustomCron(self.args).execute_script()
+        history = HistoryStore('/tmp/history.db')
+        runs = history.runs(script='./error.sh', failed=True)
+        self.assertEqual(len(runs), 2)
+        self.assertEqual(runs[0]['exit_code'], 1)
+        self.assertEqual(history.output(runs[0]['run_id']), "So far so good !\ncp: missing file operand\nTry 'cp --help' for more information.\n")
+        statistics = history.statistics()
+        self.assertEqual((statistics['count'], statistics['failures']), (3, 2))
+        self.assertLessEqual(statistics['p50'], statistics['p95'])
+        history.prune(-1)
+        self.assertEqual(history.runs(), [])
+        history.close()
+
+    def test_history_command(self):
+        history = HistoryStore('/tmp/history.db')
+        run = {'id': 'abc', 'host': 'localhost', 'script': './backup.sh', 'start': time.time() - 60,
+               'exit_code': 2, 'duration': 12.5, 'usage': None}
+        history.record(run, "Disk full\n", None)
+        history.record(dict(run, id='old', start=time.time() - 40*24*60*60, exit_code=0), "Done\n", None)
+        history.close()
+        args = ArgumentsParser().parse(['history', '--history', '/tmp/history.db', '--failed', '--since', '1h'])
+        self.assertEqual(args.command, 'history')
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            HistoryCommand(args).execute()
+        self.assertRegex(stdout.getvalue(), r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d  FAIL  exit code 2         12.5s  localhost  ./backup.sh  abc\n$')
+        args = ArgumentsParser().parse(['history', '--history', '/tmp/history.db', '--stats', '--script', './backup.sh'])
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            HistoryCommand(args).execute()
+        self.assertEqual(stdout.getvalue(), "Executions : 1\nFailures : 1\nDuration : average 12.5s, p50 12.5s, p95 12.5s, max 12.5s\n")
+
+    def test_resource_usage_stats(self):
+        self.args.script_to_execute = './hello.sh'
+        self.args.stats_path = '/tmp/stats'
+        CustomCron(self.args).execute_script()
+        os.remove("./world")
+        self.args.script_to_execute = './timeout.sh'
+        self.args.script_to_execute_timeout = 1
+        CustomCron(self.args).execute_script()
+        with open("/tmp/stats", 'r') as f:
+            stats = [json.loads(line) for line in f]
+        self.assertEqual([(record['script'], record['exit_code']) for record in stats], [('./hello.sh', 0), ('./timeout.sh', 1)])
+        self.assertGreater(stats[0]['usage']['max_rss_kb'], 0)
+        self.assertGreaterEqual(stats[1]['usage']['wall_time'], 1)
+        for key in ('user_time', 'system_time', 'block_input', 'block_output', 'voluntary_switches', 'involuntary_switches'):
+            self.assertIn(key, stats[0]['usage'])
+
+    def test_mail_resource_usage(self):
+        self.server_thread = self._instanciate_local_smtp_server(1040)
+        local_smtp_server = self.server_thread.server
+        self.args.smtp_host = '127.0.0.1'
+        self.args.smtp_port = 1040
+        self.args.script_to_execute = './hello.sh'
+        self.args.email_address = 'test@localhost'
+        self.args.email_resource_usage = True
+        CustomCron(self.args).execute_script()
+        os.remove("./world")
+        self.assertRegex(local_smtp_server.data, r'\nSubject: \[Cron : OK\] <' + os.uname()[1] + r'> : ./hello.sh \(\d+\.\ds, cpu \d+\.\d\ds, \d+ MB\)\n')
+        self.assertRegex(local_smtp_server.data, r'\n\nSo far so good !\n\n--\nWall time : \d+\.\d{3}s\nCPU time : user ')
+
+    def test_metrics_textfile(self):
+        self.args.metrics_textfile = '/tmp/metrics.prom'
+        self.args.script_to_execute = './hello.sh'
+        CustomCron(self.args).execute_script()
+        CustomCron(self.args).execute_script()
+        os.remove("./world")
+        self.args.script_to_execute = './timeout.sh'
+        self.args.script_to_execute_timeout = 1
+        CustomCron(self.args).execute_script()
+        with open("/tmp/metrics.prom", 'r') as f:
+            metrics = f.read().splitlines()
+        self.assertIn('custom_cron_runs_total{script="./hello.sh"} 2', metrics)
+        self.assertIn('custom_cron_failures_total{script="./hello.sh"} 0', metrics)
+        self.assertIn('custom_cron_timeouts_total{script="./timeout.sh"} 1', metrics)
+        self.assertIn('custom_cron_last_exit_code{script="./timeout.sh"} 1', metrics)
+        self.assertIn('custom_cron_duration_seconds_bucket{script="./hello.sh",le="+Inf"} 2', metrics)
+        self.assertIn('custom_cron_duration_seconds_bucket{script="./timeout.sh",le="0.5"} 0', metrics)
+        self.assertIn('custom_cron_output_bytes_bucket{script="./hello.sh",le="1024"} 2', metrics)
+        self.assertIn('custom_cron_output_bytes_sum{script="./hello.sh"} 34', metrics)
+        self.assertIn('# TYPE custom_cron_duration_seconds histogram', metrics)
+
+    def test_metrics_of_run_with_email_failure(self):
+        self.args.metrics_textfile = '/tmp/metrics.prom'
+        self.args.script_to_execute = './error.sh'
+        self.args.email_address = 'test@localhost'
+        self.args.smtp_host = '127.0.0.1'
+        self.args.smtp_port = 1047
+        self.assertRaises(ConnectionRefusedError, CustomCron(self.args).execute_script)
+        with open("/tmp/metrics.prom", 'r') as f:
+            metrics = f.read().splitlines()
+        self.assertIn('custom_cron_runs_total{script="./error.sh"} 1', metrics)
+        self.assertIn('custom_cron_failures_total{script="./error.sh"} 1', metrics)
+        self.assertIn('custom_cron_email_failures_total{script="./error.sh"} 1', metrics)
+
+    def test_metrics_statsd(self):
+        statsd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        statsd.bind(('127.0.0.1', 0))
+        statsd.settimeout(5)
+        self.args.metrics_statsd = '127.0.0.1:{0}'.format(statsd.getsockname()[1])
+        self.args.script_to_execute = './error.sh'
+        CustomCron(self.args).execute_script()
+        metrics = statsd.recv(65536).decode('utf-8').split('\n')
+        statsd.close()
+        self.assertIn('custom_cron.error_sh.runs:1|c', metrics)
+        self.assertIn('custom_cron.error_sh.failures:1|c', metrics)
+        self.assertIn('custom_cron.error_sh.output_bytes:80|h', metrics)
+        self.assertTrue([metric for metric in metrics if metric.startswith('custom_cron.error_sh.duration:')])
+
+    def test_metrics_never_break_the_execution(self):
+        self.args.metrics_textfile = '/unknown/metrics.prom'
+        self.args.metrics_statsd = '256.256.256.256:8125'
+        self.args.script_to_execute = './error.sh'
+        self.assertEqual(CustomCron(self.args).execute_script(), 1)
+
     def test_mail_hello_script(self):
         self.server_thread = self._instanciate_local_smtp_server(1025)
         local_smtp_server = self.server_thread.server
@@ -214,6 +455,26 @@ class TestCustomCron(unittest.TestCase):
             line = f.read()
         self.assertEqual(line, "ERROR : No script given\n", "Content do not match")
 
+    def test_startup_without_email_nor_configuration(self):
+        # A log only run must not load the email, configuration, history or metrics modules
+        src_path = os.path.join(os.path.dirname(os.getcwd()), 'src')
+        code = ("import sys, custom_cron; "
+                "custom_cron.CustomCron(custom_cron.ArgumentsParser().parse(['--logfile', '/tmp/log', './hello.sh'])).execute_script(); "
+                "print(','.join(sorted(name for name in sys.modules if name in {0!r})))").format(LAZY_MODULES)
+        # The import time is measured from the bytecode : a first run compiles the modules in a cache of its own,
+        # PYTHONDONTWRITEBYTECODE would otherwise make every run include the compilation of the sources
+        pycache_path = '/tmp/custom_cron_pycache'
+        shutil.rmtree(pycache_path, ignore_errors=True)
+        env = dict(os.environ, PYTHONPATH=src_path, PYTHONPYCACHEPREFIX=pycache_path)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        for _ in range(2):
+            result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            self.assertEqual(result.stdout.splitlines()[-1], '', "Modules loaded without being used")
+        shutil.rmtree(pycache_path, ignore_errors=True)
+        import_time = [line for line in result.stderr.splitlines() if line.endswith('| custom_cron')][0]
+        self.assertLess(int(import_time.split('|')[1]) / 1e6, STARTUP_IMPORT_TIME_TARGET, "Import of custom_cron too slow")
+
     def test_configure_smtp_with_cli(self):
         self.server_thread = self._instanciate_local_smtp_server(1033)
         local_smtp_server = self.server_thread.server
@@ -248,6 +509,81 @@ class TestCustomCron(unittest.TestCase):
             line = f.read()
         self.assertEqual(line, "ERROR : Timeout exceeded\n", "Content do not match")
 
+    def test_timeout_stops_process_group(self):
+        self.args.script_to_execute = './process_tree.sh'
+        self.args.log_path = '/tmp/log'
+        self.args.stats_path = '/tmp/stats'
+        self.args.script_to_execute_timeout = 1
+        self.args.script_to_execute_kill_grace = 1
+        CustomCron(self.args).execute_script()
+        self.args.script_to_execute_args = ['ignore']
+        start = time.monotonic()
+        CustomCron(self.args).execute_script()
+        self.assertGreaterEqual(time.monotonic() - start, 2, 'SIGKILL sent before the grace period')
+        with open("/tmp/log", 'r') as f:
+            lines = f.read().splitlines()
+        self.assertEqual([line for line in lines if not line.startswith('Child ')],
+                         ["ERROR : Timeout exceeded", "Stopping", "ERROR : Timeout exceeded"], "Partial output not kept")
+        with open("/tmp/stats", 'r') as f:
+            stats = [json.loads(line) for line in f]
+        self.assertEqual([run['usage']['killed_processes'] for run in stats], [2, 2])
+        time.sleep(0.1)
+        for line in lines:
+            if line.startswith('Child ') and os.path.exists('/proc/' + line.split()[1]):
+                with open('/proc/' + line.split()[1] + '/stat', 'r') as f:
+                    self.assertEqual(f.read().rsplit(')', 1)[1].split()[0], 'Z', 'Process started by the script still running')
+
+    def test_background_process_left_running(self):
+        self.args.script_to_execute = './background.sh'
+        self.args.log_path = '/tmp/log'
+        self.args.stats_path = '/tmp/stats'
+        self.args.script_to_execute_timeout = 2
+        start = time.monotonic()
+        self.assertEqual(CustomCron(self.args).execute_script(), 0)
+        self.assertLess(time.monotonic() - start, 1, 'Background process of the script waited for')
+        with open("/tmp/log", 'r') as f:
+            self.assertEqual(f.read(), "Start\nDone\n", "Content do not match")
+        with open("/tmp/stats", 'r') as f:
+            self.assertEqual(json.loads(f.read())['usage']['killed_processes'], 0)
+
+    def test_resource_controls_applied(self):
+        self.args.script_to_execute = './resource_controls.sh'
+        self.args.log_path = '/tmp/log'
+        self.args.nice = 5
+        self.args.cpu_affinity = '0'
+        self.args.limit_files = 100
+        self.assertEqual(CustomCron(self.args).execute_script(), 0)
+        with open("/tmp/log", 'r') as f:
+            self.assertEqual(f.read(), "nice 5\nfiles 100\nCpus_allowed_list:\t0\n", "Controls not applied")
+        # Started by the fork server, not forked from a thread of the wrapper
+        self.args.script_to_execute = '/bin/sh'
+        self.args.script_to_execute_args = ['-c', 'echo $PPID']
+        self.assertEqual(CustomCron(self.args).execute_script(), 0)
+        with open("/tmp/log", 'r') as f:
+            self.assertNotEqual(f.read().splitlines()[-1], str(os.getpid()), "Controlled script forked by the wrapper")
+        self.assertEqual(ResourceControls.parse_ionice('idle'), 3 << 13)
+        self.assertEqual(ResourceControls.parse_ionice('best-effort:7'), 2 << 13 | 7)
+        self.assertEqual(ResourceControls.parse_cpu_affinity('0-2,5'), {0, 1, 2, 5})
+        self.assertRaises(ValueError, ResourceControls.parse_ionice, 'fast:9')
+
+    def test_limit_exceeded_reported(self):
+        self.server_thread = self._instanciate_local_smtp_server(1042)
+        local_smtp_server = self.server_thread.server
+        self.args.smtp_host = '127.0.0.1'
+        self.args.smtp_port = 1042
+        self.args.email_address = 'test@localhost'
+        self.args.log_path = '/tmp/log'
+        self.args.script_to_execute = '/bin/sh'
+        self.args.script_to_execute_args = ['-c', 'while :; do :; done']
+        self.args.limit_cpu = 1
+        CustomCron(self.args).execute_script()
+        self.assertIn('Subject: [Cron : FAIL] <' + os.uname()[1] + '> : /bin/sh (limit exceeded: cpu)\n', local_smtp_server.data)
+        self.args.script_to_execute_args = ['-c', 'head -c 100000 /dev/zero > /tmp/log.big']
+        self.args.limit_file_size = 1000
+        CustomCron(self.args).execute_script()
+        with open("/tmp/log", 'r') as f:
+            self.assertEqual(f.read().splitlines()[-1], "ERROR : Limit exceeded : file_size")
+
     def test_exceeded_timeout_configuration_file(self):
         self.args.configuration_path = os.getcwd() + '/timeout_configuration.ini'
         custom_cron = CustomCron(self.args)
@@ -257,6 +593,571 @@ class TestCustomCron(unittest.TestCase):
             line = f.read()
         self.assertEqual(line, "ERROR : Timeout exceeded\n", "Content do not match")
 
+    def test_log_written_while_running(self):
+        self.args.script_to_execute = './progress.sh'
+        self.args.log_path = '/tmp/log'
+        custom_cron = CustomCron(self.args)
+        execution = threading.Thread(target=custom_cron.execute_script)
+        execution.start()
+        # The log is flushed once the script stays quiet for a second
+        time.sleep(1.5)
+        with open("/tmp/log", 'r') as f:
+            partial_log = f.read()
+        execution.join()
+        with open("/tmp/log", 'r') as f:
+            line = f.read()
+        self.assertEqual(partial_log, "Step 1\n", "Log not written while running")
+        self.assertEqual(line, "Step 1\nStep 2\n", "Content do not match")
+
+    def test_email_body_truncated(self):
+        email_body = EmailBodySink(10)
+        email_body.write("Hello")
+        email_body.write(" World !\n")
+        self.assertEqual(email_body.getvalue(), "Hello\n[... 0 lines (4 characters) elided ...]\nld !\n", "Bad email body")
+
+    def test_email_body_lines(self):
+        email_body = EmailBodySink(1024, body_lines=2)
+        for line in range(1, 11):
+            email_body.write("Line {0}\n".format(line))
+        self.assertEqual(email_body.getvalue(), "Line 1\nLine 2\n[... 6 lines (42 characters) elided ...]\nLine 9\nLine 10\n", "Bad email body")
+        email_body = EmailBodySink(1024, body_lines=2)
+        email_body.write("Line 1\nLine 2\nLine 3\nLine 4\n")
+        self.assertEqual(email_body.getvalue(), "Line 1\nLine 2\nLine 3\nLine 4\n", "Bad email body")
+
+    def test_mail_full_output_attached(self):
+        self.server_thread = self._instanciate_local_smtp_server(1039)
+        local_smtp_server = self.server_thread.server
+        self.args.smtp_host = '127.0.0.1'
+        self.args.smtp_port = 1039
+        self.args.script_to_execute = './hello_args.sh'
+        self.args.script_to_execute_args = ['Hello', 'world', 'foo bar']
+        self.args.email_address = 'test@localhost'
+        self.args.email_body_lines = 0
+        self.args.email_attach_above = 10
+        custom_cron = CustomCron(self.args)
+        custom_cron.execute_script()
+        os.remove("./world_args")
+        message = email.message_from_string(local_smtp_server.data)
+        body, attachment = message.get_payload()
+        self.assertEqual(body.get_payload(), "[... 1 lines (48 characters) elided ...]\n", "Bad email body")
+        self.assertEqual(attachment.get_filename(), 'output.txt.gz')
+        self.assertEqual(gzip.decompress(attachment.get_payload(decode=True)), b"Arg 1 : Hello - Arg 2 : world - Arg 3 : foo bar\n")
+
+    def test_cron_expression_next_fire(self):
+        now = datetime.datetime(2016, 7, 14, 10, 42, 30)
+        self.assertEqual(CronExpression('* * * * *').next_fire(now), datetime.datetime(2016, 7, 14, 10, 43))
+        self.assertEqual(CronExpression('*/15 * * * *').next_fire(now), datetime.datetime(2016, 7, 14, 10, 45))
+        self.assertEqual(CronExpression('0 */1 * * *').next_fire(now), datetime.datetime(2016, 7, 14, 11, 0))
+        self.assertEqual(CronExpression('30 2 * * *').next_fire(now), datetime.datetime(2016, 7, 15, 2, 30))
+        self.assertEqual(CronExpression('0 0 1,15 * *').next_fire(now), datetime.datetime(2016, 7, 15, 0, 0))
+        self.assertEqual(CronExpression('0 9 * * 1-5').next_fire(now), datetime.datetime(2016, 7, 15, 9, 0))
+        self.assertEqual(CronExpression('0 9 * * 7').next_fire(now), datetime.datetime(2016, 7, 17, 9, 0))
+        self.assertEqual(CronExpression('@yearly').next_fire(now), datetime.datetime(2017, 1, 1, 0, 0))
+        self.assertRaises(ValueError, CronExpression, '61 * * * *')
+
+    def test_cron_expression_names(self):
+        now = datetime.datetime(2016, 7, 14, 10, 42, 30)
+        self.assertEqual(CronExpression('0 9 * * mon-fri').next_fire(now), datetime.datetime(2016, 7, 15, 9, 0))
+        self.assertEqual(CronExpression('0 9 * * SUN').next_fire(now), datetime.datetime(2016, 7, 17, 9, 0))
+        self.assertEqual(CronExpression('0 0 1 jan,Jul *').next_fire(now), datetime.datetime(2017, 1, 1, 0, 0))
+        with self.assertRaisesRegex(ValueError, 'Invalid cron expression'):
+            CronExpression('0 9 * * monday')
+        with self.assertRaisesRegex(ValueError, 'Invalid cron expression'):
+            CronExpression('0 9 * mon *')
+
+    def test_daemon_runs_due_jobs(self):
+        self.args.daemon_path = './crontab'
+        self.args.log_path = '/tmp/log'
+        scheduler = Scheduler(self.args)
+        self.assertEqual(len(scheduler.jobs), 2)
+        scheduler.schedule(datetime.datetime(2016, 7, 14, 10, 42, 30))
+        scheduler.run_pending(datetime.datetime(2016, 7, 14, 10, 43))
+        scheduler.join()
+        scheduler.run_pending(datetime.datetime(2016, 7, 14, 10, 44))
+        scheduler.join()
+        scheduler.resources.close()
+        if os.path.isfile("./world_args"):
+            os.remove("./world_args")
+        with open("/tmp/log", 'r') as f:
+            line = f.read()
+        self.assertEqual(line, "Arg 1 : Hello - Arg 2 : big world - Arg 3 : \n" * 2, "Content do not match")
+
+    def test_daemon_executions_bounded(self):
+        self.args.daemon_path = './crontab'
+        self.args.log_path = '/tmp/log'
+        self.args.max_parallel = 1
+        scheduler = Scheduler(self.args)
+        scheduler.schedule(datetime.datetime(2016, 7, 14, 23, 59, 30))
+        # Both jobs are due at midnight
+        scheduler.run_pending(datetime.datetime(2016, 7, 15, 0, 0))
+        self.assertEqual(len(scheduler._threads), 1, 'More executions than max_parallel')
+        scheduler.join()
+        scheduler.run_pending(datetime.datetime(2016, 7, 15, 0, 0))
+        scheduler.join()
+        scheduler.resources.close()
+        for path in ("./world", "./world_args"):
+            if os.path.isfile(path):
+                os.remove(path)
+        with open("/tmp/log", 'r') as f:
+            self.assertEqual(len(f.read().splitlines()), 2, 'Due job not executed once a worker is free')
+
+    def test_mail_queued_in_outbox(self):
+        self.server_thread = self._instanciate_local_smtp_server(1035)
+        local_smtp_server = self.server_thread.server
+        self.args.smtp_host = '127.0.0.1'
+        self.args.smtp_port = 1035
+        self.args.script_to_execute = './hello.sh'
+        self.args.email_address = 'test@localhost'
+        self.args.email_outbox = '/tmp/outbox'
+        custom_cron = CustomCron(self.args)
+        custom_cron.execute_script()
+        for _ in range(50):
+            if local_smtp_server.rcpttos is not None and len(Outbox('/tmp/outbox').pending()) == 0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(local_smtp_server.rcpttos, ['test@localhost'], 'Wrong dest email')
+        self.assertEqual(Outbox('/tmp/outbox').pending(), [], 'Outbox not drained')
+
+    def test_outbox_sender_detached(self):
+        # A relay which never sends its banner keeps the sender connecting for minutes
+        relay = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        relay.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        relay.bind(('127.0.0.1', 1044))
+        relay.listen(1)
+        try:
+            start = time.monotonic()
+            # Cron reads the output of the job until the end
+            result = subprocess.run([sys.executable, '../src/custom_cron.py', '--smtp_host', '127.0.0.1', '--smtp_port', '1044',
+                                     '--email_to', 'test@localhost', '--email_outbox', '/tmp/outbox', './error.sh'],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=20)
+            self.assertLess(time.monotonic() - start, 5, 'Wrapper output held by the email sender')
+            self.assertEqual(len(Outbox('/tmp/outbox').pending()), 1)
+        finally:
+            relay.close()
+
+    def test_outbox_drained_in_batch(self):
+        self.server_thread = self._instanciate_local_smtp_server(1036)
+        local_smtp_server = self.server_thread.server
+        outbox = Outbox('/tmp/outbox')
+        outbox.put(['test@localhost'], 'Subject: first\n\nfirst')
+        outbox.put(['foo@bar'], 'Subject: second\n\nsecond')
+        connections = []
+        def connect():
+            connections.append(SMTP('127.0.0.1', 1036))
+            return connections[-1]
+        self.assertEqual(outbox.drain(SMTPConnectionPool(connect)), 2)
+        self.assertEqual(len(connections), 1, 'Emails not sent over a single session')
+        self.assertEqual(outbox.pending(), [], 'Outbox not drained')
+        self.assertEqual(local_smtp_server.rcpttos, ['foo@bar'], 'Wrong dest email')
+
+    def test_outbox_refused_email_not_blocking(self):
+        self.server_thread = self._instanciate_local_smtp_server(1043)
+        local_smtp_server = self.server_thread.server
+        outbox = Outbox('/tmp/outbox')
+        refused = outbox.put(['refused@localhost'], 'Subject: refused\n\nrefused')
+        busy = outbox.put(['busy@localhost'], 'Subject: busy\n\nbusy')
+        outbox.put(['test@localhost'], 'Subject: first\n\nfirst')
+        outbox.put(['foo@bar'], 'Subject: second\n\nsecond')
+        self.assertEqual(outbox.drain(SMTPConnectionPool(lambda: SMTP('127.0.0.1', 1043))), 2)
+        self.assertEqual([rcpttos for _, rcpttos, _ in local_smtp_server.messages], [['test@localhost'], ['foo@bar']])
+        self.assertEqual(outbox.pending(), [busy], 'Temporary failure not retried')
+        with open(os.path.join('/tmp/outbox', busy), 'r') as f:
+            self.assertEqual(json.load(f)['attempts'], 1)
+        with open(os.path.join('/tmp/outbox/failed', refused), 'r') as f:
+            self.assertIn('Mailbox unavailable', json.load(f)['error'], 'Permanent failure not set aside')
+
+    def test_outbox_retry_with_backoff(self):
+        outbox = Outbox('/tmp/outbox')
+        name = outbox.put(['test@localhost'], 'Subject: retry\n\nretry')
+        def connect():
+            raise ConnectionRefusedError()
+        self.assertEqual(outbox.drain(SMTPConnectionPool(connect)), 0)
+        self.assertEqual(outbox.pending(), [name], 'Email lost')
+        with open(os.path.join('/tmp/outbox', name), 'r') as f:
+            email = json.load(f)
+        self.assertEqual(email['attempts'], 1)
+        self.assertGreater(email['next_attempt'], time.time())
+        self.assertEqual(outbox.drain(SMTPConnectionPool(connect)), 0)
+        with open(os.path.join('/tmp/outbox', name), 'r') as f:
+            self.assertEqual(json.load(f)['attempts'], 1, 'Email retried before its backoff delay')
+
+    def test_outbox_sender_retries_postponed_email(self):
+        self.args.smtp_host = '127.0.0.1'
+        self.args.smtp_port = 1048
+        self.args.email_outbox = '/tmp/outbox'
+        name = Outbox('/tmp/outbox').put(['test@localhost'], 'Subject: retry\n\nretry')
+        custom_cron = CustomCron(self.args)
+        with unittest.mock.patch.object(Outbox, 'RETRY_BASE_DELAY', 1):
+            # The SMTP server is down on the first attempt and back before the retry
+            sender = threading.Thread(target=custom_cron.drain_outbox)
+            sender.start()
+            time.sleep(0.5)
+            self.server_thread = self._instanciate_local_smtp_server(1048)
+            sender.join(10)
+        self.assertFalse(sender.is_alive(), 'Sender not stopped once the outbox is empty')
+        self.assertEqual(self.server_thread.server.rcpttos, ['test@localhost'], 'Postponed email not sent')
+        self.assertNotIn(name, Outbox('/tmp/outbox').pending())
+
+    def test_configuration_file_with_jobs(self):
+        self.args.configuration_path = os.getcwd() + '/jobs_configuration.ini'
+        custom_cron = CustomCron(self.args)
+        self.assertEqual([job['name'] for job in custom_cron.jobs], ['hello', 'error', 'slow'])
+        self.assertEqual(custom_cron.max_parallel, 2)
+        start = time.monotonic()
+        exit_code = custom_cron.execute_script()
+        self.assertLess(time.monotonic() - start, 2, 'Jobs not executed in parallel')
+        self.assertEqual(exit_code, 1, 'Failed jobs not reported')
+        if os.path.isfile("./world_args"):
+            os.remove("./world_args")
+        with open("/tmp/log", 'r') as f:
+            lines = sorted(f.readlines())
+        with open("/tmp/log2", 'r') as f:
+            error_log = f.read()
+        os.remove("/tmp/log2")
+        self.assertEqual(lines, ["Arg 1 : Hello - Arg 2 : world - Arg 3 : \n", "ERROR : Timeout exceeded\n"], "Content do not match")
+        self.assertEqual(error_log, "So far so good !\ncp: missing file operand\nTry 'cp --help' for more information.\n", "Content do not match")
+
+    def test_configuration_directory(self):
+        os.makedirs("/tmp/conf.d/jobs")
+        with open("/tmp/conf.d/00-main.ini", 'w') as f:
+            f.write("[log]\npath = /tmp/log\n\n[include]\ndirectory = jobs\n")
+        with open("/tmp/conf.d/10-workers.ini", 'w') as f:
+            f.write("[workers]\nmax_parallel = 3\n")
+        for name in ('hello', 'error'):
+            with open("/tmp/conf.d/jobs/{0}.ini".format(name), 'w') as f:
+                f.write("[job:{0}]\npath = ./{0}.sh\ntimeout = 10\n".format(name))
+        self.args.configuration_path = "/tmp/conf.d"
+        custom_cron = CustomCron(self.args)
+        self.assertEqual(custom_cron.log_path, "/tmp/log")
+        self.assertEqual(custom_cron.max_parallel, 3)
+        self.assertEqual([(job['name'], job['timeout']) for job in custom_cron.jobs], [('error', 10), ('hello', 10)])
+        with open("/tmp/conf.d/jobs/other.ini", 'w') as f:
+            f.write("[job:hello]\npath = ./hello.sh\n")
+        self.assertRaises(ValueError, CustomCron, self.args)
+
+    def test_configuration_cache(self):
+        os.makedirs("/tmp/conf.d")
+        for name in ('hello', 'error'):
+            with open("/tmp/conf.d/{0}.ini".format(name), 'w') as f:
+                f.write("[job:{0}]\npath = ./{0}.sh\n".format(name))
+        loader = ConfigurationLoader("/tmp/conf.d", "/tmp/conf.d/cache")
+        self.assertEqual(sorted(loader.load()), ['job:error', 'job:hello'])
+        self.assertEqual(loader.parsed_paths, ["/tmp/conf.d/error.ini", "/tmp/conf.d/hello.ini"])
+        loader = ConfigurationLoader("/tmp/conf.d", "/tmp/conf.d/cache")
+        self.assertEqual(loader.load()['job:hello'], {'path': './hello.sh'})
+        self.assertEqual(loader.parsed_paths, [], "Unchanged files parsed again")
+        with open("/tmp/conf.d/hello.ini", 'a') as f:
+            f.write("timeout = 30\n")
+        self.assertEqual(loader.load()['job:hello'], {'path': './hello.sh', 'timeout': 30})
+        self.assertEqual(loader.parsed_paths, ["/tmp/conf.d/hello.ini"], "Only the changed file must be parsed")
+        with open("/tmp/conf.d/error.ini", 'a') as f:
+            f.write("timeout = soon\n")
+        self.assertRaises(ValueError, loader.load)
+
+    def test_splay_delay(self):
+        self.args.splay = 300
+        self.args.script_to_execute = './hello.sh'
+        delay = CustomCron(self.args)._splay_delay()
+        self.assertTrue(0 <= delay < 300)
+        self.assertEqual(CustomCron(self.args)._splay_delay(), delay, 'Splay delay not deterministic')
+        self.args.script_to_execute = './error.sh'
+        self.assertNotEqual(CustomCron(self.args)._splay_delay(), delay, 'Same splay delay for every script')
+
+    def test_splay_and_slot_validated(self):
+        self.args.script_to_execute = './error.sh'
+        self.args.splay = 0
+        custom_cron = CustomCron(self.args)
+        self.assertIsNone(custom_cron.splay, 'Splay of 0 not ignored')
+        self.assertEqual(custom_cron.execute_script(), 1)
+        self.args.splay = -1
+        self.assertRaises(ValueError, CustomCron, self.args)
+        self.args.splay = None
+        self.args.slot = 'heavy:0'
+        self.assertRaises(ValueError, CustomCron, self.args)
+        self.args.slot = 'heavy:many'
+        self.assertRaises(ValueError, CustomCron, self.args)
+
+    def test_splay_of_jobs_not_holding_workers(self):
+        self.args.configuration_path = os.getcwd() + '/jobs_configuration.ini'
+        self.args.max_parallel = 1
+        custom_cron = CustomCron(self.args)
+        custom_cron.splay = 3
+        start = time.monotonic()
+        with unittest.mock.patch.object(CustomCron, '_splay_delay', return_value=2), \
+                contextlib.redirect_stdout(io.StringIO()):
+            custom_cron.execute_script()
+        self.assertLess(time.monotonic() - start, 4.5, 'Jobs waiting for their splay in the workers')
+        for path in ("./world_args", "/tmp/log2"):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def test_slot_limits_concurrent_scripts(self):
+        self.args.script_to_execute = './progress.sh'
+        self.args.slot = 'heavy:1'
+        self.args.slots_directory = '/tmp/slots'
+        custom_cron = CustomCron(self.args)
+        start = time.monotonic()
+        threads = [threading.Thread(target=custom_cron.execute_script) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.monotonic() - start, 3.5, 'Scripts of a slot of size 1 executed at once')
+
+    def test_slot_waiters_served_in_order(self):
+        holder = HostSemaphore('/tmp/slots', 'heavy', 1)
+        holder.acquire()
+        # A ticket left by a dead waiter must not block the queue
+        with open('/tmp/slots/heavy.queue/00000000000000000000-1-1', 'w'):
+            pass
+        served = []
+
+        def wait_for_slot(index):
+            slot = HostSemaphore('/tmp/slots', 'heavy', 1)
+            slot.acquire()
+            served.append(index)
+            slot.release()
+
+        threads = []
+        for index in range(3):
+            threads.append(threading.Thread(target=wait_for_slot, args=(index,)))
+            threads[-1].start()
+            time.sleep(0.05)
+        holder.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(served, [0, 1, 2], 'Slot not given in the order of arrival')
+        self.assertEqual(os.listdir('/tmp/slots/heavy.queue'), [])
+
+    def test_slot_released_when_sink_fails(self):
+        self.args.script_to_execute = './hello.sh'
+        self.args.log_path = '/tmp/log'
+        self.args.slot = 'heavy:1'
+        self.args.slots_directory = '/tmp/slots'
+        with unittest.mock.patch.object(CustomCron, '_log_file', side_effect=OSError('Read-only file system')):
+            self.assertRaises(OSError, CustomCron(self.args).execute_script)
+        slot = HostSemaphore('/tmp/slots', 'heavy', 1)
+        waiter = threading.Thread(target=slot.acquire)
+        waiter.start()
+        waiter.join(2)
+        self.assertFalse(waiter.is_alive(), 'Slot still held after a failed execution')
+        slot.release()
+
+    def test_lease_single_execution(self):
+        self.args.script_to_execute = './lease_token.sh'
+        self.args.log_path = '/tmp/log'
+        self.args.lease = 'file:///tmp/leases'
+        scheduled_time = time.time() // 60 * 60
+        # One instance per host of the fleet, the second one starting a few seconds later
+        self.assertEqual(CustomCron(self.args).execute_script(scheduled_time), 0)
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            self.assertEqual(CustomCron(self.args).execute_script(scheduled_time + 5), 0)
+        self.assertEqual(stdout.getvalue(), "Skipped : ./lease_token.sh is executed by an other host\n")
+        with open('/tmp/log', 'r') as log:
+            self.assertEqual(log.read(), "Lease token 1\n", "Instance not executed exactly once")
+        self.assertEqual(CustomCron(self.args).execute_script(scheduled_time + 60), 0)
+
+    def test_lease_backend_unavailable(self):
+        self.server_thread = self._instanciate_local_smtp_server(1046)
+        self.args.smtp_host = '127.0.0.1'
+        self.args.smtp_port = 1046
+        self.args.email_address = 'test@localhost'
+        self.args.script_to_execute = './lease_token.sh'
+        self.args.log_path = '/tmp/log'
+        # A file in place of the directory of the leases, like a shared storage gone
+        open('/tmp/leases', 'w').close()
+        try:
+            self.args.lease = '/tmp/leases'
+            self.assertEqual(CustomCron(self.args).execute_script(), 1)
+        finally:
+            os.remove('/tmp/leases')
+        with open('/tmp/log', 'r') as log:
+            self.assertTrue(log.read().startswith("ERROR : Lease backend unavailable : "), "Lease error not logged")
+        self.assertIn('Subject: [Cron : FAIL]', self.server_thread.server.data)
+
+    def test_lease_taken_over_after_expiry(self):
+        backend = FileLeaseBackend('/tmp/leases')
+        self.assertEqual(backend.acquire('job/1', 'host1', 0.2), 1)
+        self.assertIsNone(backend.acquire('job/1', 'host2', 0.2), 'Lease held by two hosts')
+        time.sleep(0.3)
+        self.assertEqual(backend.acquire('job/1', 'host2', 10), 2, 'Expired lease not taken over')
+        self.assertFalse(backend.renew('job/1', 1, 'host1', 10), 'Previous holder not fenced off')
+        self.assertTrue(backend.complete('job/1', 2, 'host2'))
+        self.assertIsNone(backend.acquire('job/1', 'host3', 10), 'Done instance executed again')
+        self.assertEqual(sorted(os.listdir('/tmp/leases/job')), ['1.1', '1.2'])
+
+    def test_lease_renewed_while_running(self):
+        self.args.script_to_execute = './progress.sh'
+        self.args.lease = '/tmp/leases'
+        self.args.lease_duration = 1
+        custom_cron = CustomCron(self.args)
+        scheduled_time = time.time()
+        execution = threading.Thread(target=custom_cron.execute_script, args=(scheduled_time,))
+        execution.start()
+        time.sleep(1.5)
+        self.assertIsNone(FileLeaseBackend('/tmp/leases').acquire(custom_cron._lease_name(scheduled_time), 'host2', 1),
+                          'Lease of a running script expired')
+        execution.join()
+
+    def test_lease_abandoned_when_sink_fails(self):
+        self.args.script_to_execute = './hello.sh'
+        self.args.log_path = '/tmp/log'
+        self.args.lease = '/tmp/leases'
+        self.args.lease_duration = 0.3
+        custom_cron = CustomCron(self.args)
+        scheduled_time = time.time()
+        with unittest.mock.patch.object(CustomCron, '_log_file', side_effect=OSError('Read-only file system')):
+            self.assertRaises(OSError, custom_cron.execute_script, scheduled_time)
+        time.sleep(0.5)
+        # Neither renewed forever nor marked as done, an other host executes the instance
+        self.assertIsNotNone(FileLeaseBackend('/tmp/leases').acquire(custom_cron._lease_name(scheduled_time), 'host2', 1),
+                             'Lease of a failed execution not given up')
+
+    def test_python_entry_point(self):
+        self.args.script_to_execute = 'python:tests.python_job:hello'
+        self.args.script_to_execute_args = ['big', 'world']
+        self.args.log_path = '/tmp/log'
+        self.assertEqual(CustomCron(self.args).execute_script(), 0)
+        with open('/tmp/log', 'r') as log:
+            self.assertEqual(log.read(), "Hello big world\n")
+
+    def test_python_entry_point_exit_code(self):
+        self.args.log_path = '/tmp/log'
+        self.args.script_to_execute = 'python:tests.python_job:fail'
+        self.assertEqual(CustomCron(self.args).execute_script(), 1)
+        with open('/tmp/log', 'r') as log:
+            self.assertTrue(log.read().endswith("ValueError: Bad value\n"), "Exception not in the output")
+        self.args.script_to_execute = 'python:tests.python_job:exit_status'
+        self.args.script_to_execute_args = ['3']
+        self.assertEqual(CustomCron(self.args).execute_script(), 3)
+
+    def test_python_entry_point_preloaded(self):
+        self.args.script_to_execute = 'python:tests.python_job:preloaded'
+        self.args.python_preload = 'tests.python_job'
+        self.args.log_path = '/tmp/log'
+        resources = SharedResources()
+        try:
+            custom_cron = CustomCron(self.args, resources)
+            self.assertEqual(custom_cron.execute_script(), 0)
+            self.assertEqual(custom_cron.execute_script(), 0)
+            fork_server_pid = resources.fork_server(['tests.python_job']).pid
+        finally:
+            resources.close()
+        with open('/tmp/log', 'r') as log:
+            self.assertEqual(log.read(), "Preloaded\nPreloaded\n", "Module imported again by the worker")
+        self.assertRaises(ChildProcessError, os.waitpid, fork_server_pid, os.WNOHANG)
+
+    def test_python_entry_point_timeout(self):
+        self.args.script_to_execute = 'python:tests.python_job:sleep'
+        self.args.script_to_execute_timeout = 1
+        self.args.log_path = '/tmp/log'
+        start = time.monotonic()
+        self.assertEqual(CustomCron(self.args).execute_script(), 1)
+        self.assertLess(time.monotonic() - start, 5, 'Worker not stopped on timeout')
+        with open('/tmp/log', 'r') as log:
+            self.assertEqual(log.read(), "Sleeping\nERROR : Timeout exceeded\n")
+
+    def test_script_arg_precedence_over_jobs(self):
+        self.args.configuration_path = os.getcwd() + '/jobs_configuration.ini'
+        self.args.script_to_execute = './hello.sh'
+        custom_cron = CustomCron(self.args)
+        self.assertEqual(custom_cron.jobs, [])
+        self.assertEqual(custom_cron.execute_script(), 0)
+        os.remove("./world")
+
+    def test_mail_digest(self):
+        self.server_thread = self._instanciate_local_smtp_server(1037)
+        local_smtp_server = self.server_thread.server
+        self.args.smtp_host = '127.0.0.1'
+        self.args.smtp_port = 1037
+        self.args.email_address = 'test@localhost,foo@bar'
+        self.args.email_digest = '/tmp/digest'
+        self.args.email_digest_interval = 3600
+        self.args.script_to_execute = './hello.sh'
+        CustomCron(self.args).execute_script()
+        self.args.script_to_execute = './error.sh'
+        CustomCron(self.args).execute_script()
+        os.remove("./world")
+        self.assertIsNone(local_smtp_server.rcpttos, 'Digest sent before the end of its interval')
+        self.args.email_digest_interval = 0
+        CustomCron(self.args).flush_digest()
+        # One email per recipient, the last one is sent to test@localhost
+        self.assertEqual(local_smtp_server.rcpttos, ['test@localhost'], 'Wrong dest email')
+        self.assertIn('Subject: [Cron : FAIL] <' + os.uname()[1] + '> : 2 executions, 1 failed\n', local_smtp_server.data)
+        self.assertIn('> : ./hello.sh (exit code 0, ', local_smtp_server.data)
+        self.assertIn('> : ./error.sh (exit code 1, ', local_smtp_server.data)
+        self.assertEqual(glob.glob('/tmp/digest/*.spool') + glob.glob('/tmp/digest/*.sending'), [])
+
+    def test_mail_digest_failures_immediately(self):
+        self.server_thread = self._instanciate_local_smtp_server(1038)
+        local_smtp_server = self.server_thread.server
+        self.args.smtp_host = '127.0.0.1'
+        self.args.smtp_port = 1038
+        self.args.email_address = 'test@localhost'
+        self.args.email_digest = '/tmp/digest'
+        self.args.email_digest_interval = 3600
+        self.args.email_digest_failures_immediately = True
+        self.args.script_to_execute = './unknown.sh'
+        CustomCron(self.args).execute_script()
+        self.assertEqual(local_smtp_server.rcpttos, ['test@localhost'], 'Wrong dest email')
+        self.assertIn('Subject: [Cron : FAIL] <' + os.uname()[1] + '> : ./unknown.sh\n', local_smtp_server.data)
+
+    def test_failure_fingerprint(self):
+        alerts = AlertCache('/tmp/alerts.json', 3600, 3600)
+        fingerprint = alerts.fingerprint(1, "2016-07-14 10:42:01 backup 42 failed, id 5f3a9c1e2b\n")
+        self.assertEqual(alerts.fingerprint(1, "2016-07-15T11:00:59Z backup 43 failed, id 7a8b9c0d1e\n"), fingerprint)
+        self.assertNotEqual(alerts.fingerprint(1, "2016-07-14 10:42:01 restore 42 failed, id 5f3a9c1e2b\n"), fingerprint)
+        self.assertNotEqual(alerts.fingerprint(2, "2016-07-14 10:42:01 backup 42 failed, id 5f3a9c1e2b\n"), fingerprint)
+
+    def test_mail_failure_deduplicated(self):
+        self.server_thread = self._instanciate_local_smtp_server(1041)
+        local_smtp_server = self.server_thread.server
+        with open('/tmp/flaky.sh', 'w') as f:
+            f.write("#! /bin/sh\n\necho \"Run at $(date +%s%N)\"\ntest -f /tmp/flaky_ok\n")
+        os.chmod('/tmp/flaky.sh', 0o755)
+        self.args.smtp_host = '127.0.0.1'
+        self.args.smtp_port = 1041
+        self.args.email_address = 'test@localhost'
+        self.args.email_only_on_fail = True
+        self.args.email_dedup = '/tmp/alerts.json'
+        self.args.script_to_execute = '/tmp/flaky.sh'
+        subject = 'Subject: [Cron : {0}] <' + os.uname()[1] + '> : /tmp/flaky.sh{1}\n'
+        for _ in range(3):
+            CustomCron(self.args).execute_script()
+        self.assertEqual(len(local_smtp_server.messages), 1, 'Same failure sent on every execution')
+        self.assertIn(subject.format('FAIL', ''), local_smtp_server.data)
+        self.args.email_reminder_interval = 0
+        CustomCron(self.args).execute_script()
+        self.assertEqual(len(local_smtp_server.messages), 2, 'No reminder sent')
+        self.assertIn(' (failed 4 times since ', local_smtp_server.data)
+        open('/tmp/flaky_ok', 'w').close()
+        CustomCron(self.args).execute_script()
+        self.assertEqual(len(local_smtp_server.messages), 3, 'No recovery notice sent')
+        self.assertIn(subject.format('OK', ' (recovered after 4 failures)'), local_smtp_server.data)
+        CustomCron(self.args).execute_script()
+        self.assertEqual(len(local_smtp_server.messages), 3, 'Success sent despite only on fail')
+
+    def test_mail_failure_resent_after_failed_delivery(self):
+        self.args.script_to_execute = './error.sh'
+        self.args.smtp_host = '127.0.0.1'
+        self.args.smtp_port = 1045
+        self.args.email_address = 'test@localhost'
+        self.args.email_dedup = '/tmp/alerts.json'
+        # No SMTP server yet, the first failure is not delivered
+        self.assertRaises(ConnectionRefusedError, CustomCron(self.args).execute_script)
+        self.server_thread = self._instanciate_local_smtp_server(1045)
+        CustomCron(self.args).execute_script()
+        self.assertEqual(len(self.server_thread.server.messages), 1, 'Failure never reported')
+        CustomCron(self.args).execute_script()
+        self.assertEqual(len(self.server_thread.server.messages), 1, 'Same failure sent on every execution')
+
+    def _instanciate_local_log_collector(self, port, protocol):
+        log_collector = LocalLogCollector(port, protocol)
+        log_collector.start()
+        while log_collector.ready is not True:
+            pass
+        return log_collector
+
     def _instanciate_local_smtp_server(self, port):
         smtp_server = LocalSMTPServer(port)
         smtp_server.start()
@@ -269,50 +1170,54 @@ class ScriptArguments(object):
 
     def __init__(self):
         self.log_path = None
+        self.log_format = None
+        self.log_max_size = None
+        self.log_ship = None
+        self.log_ship_spool = None
+        self.history_path = None
+        self.metrics_textfile = None
+        self.metrics_statsd = None
         self.configuration_path = None
+        self.configuration_cache = None
         self.smtp_host = None
         self.smtp_port = None
         self.smtp_login = None
         self.smtp_password = None
         self.email_address = None
         self.email_only_on_fail = False
+        self.email_outbox = None
+        self.email_digest = None
+        self.email_digest_interval = None
+        self.email_digest_failures_immediately = False
+        self.email_max_body_size = None
+        self.email_body_lines = None
+        self.email_attach_above = None
+        self.email_resource_usage = False
+        self.email_dedup = None
+        self.email_reminder_interval = None
+        self.stats_path = None
         self.script_to_execute = None
         self.script_to_execute_timeout = None
+        self.script_to_execute_kill_grace = None
+        self.nice = None
+        self.ionice = None
+        self.cpu_affinity = None
+        self.limit_cpu = None
+        self.limit_memory = None
+        self.limit_files = None
+        self.limit_file_size = None
         self.script_to_execute_args = []
+        self.python_preload = None
+        self.max_parallel = None
+        self.max_load = None
+        self.splay = None
+        self.slot = None
+        self.slots_directory = None
+        self.lease = None
+        self.lease_duration = None
+        self.lease_window = None
+        self.daemon_path = None
 
 
-class LocalSMTPServer(threading.Thread):
-
-    def __init__(self, port):
-        threading.Thread.__init__(self)
-        self.ready = False
-        self.server = None
-        self._port = port
-
-    def run(self):
-        self.server = CustomSMTPServer(('127.0.0.1', self._port), None)
-        self.ready = True
-        asyncore.loop(timeout=1)
-
-    def stop(self):
-        self.server.close()
-
-
-class CustomSMTPServer(smtpd.SMTPServer):
-
-    def __init__(self, local_addr, remote_addr):
-        smtpd.SMTPServer.__init__(self, local_addr, remote_addr, decode_data=True)
-        self.peer = None
-        self.mailfrom = None
-        self.rcpttos = None
-        self.data = None
-
-    def process_message(self, peer, mailfrom, rcpttos, data):
-        self.peer = peer
-        self.mailfrom = mailfrom
-        self.rcpttos = rcpttos
-        self.data = data
-        return
-
 if __name__ == "__main__":
     unittest.main()